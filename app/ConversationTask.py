@@ -40,7 +40,7 @@ class ConversationTask:
         self.messages = []
 
         # feed with documents
-        documents = self.pipeline_task.final_df[self.column].tolist()
+        documents = self.pipeline_task.get_documents(columns=[self.column])[self.column].tolist()
         self.add_request(_rag_system_prompt + '<SEP>'.join(documents))
 
 
@@ -1,18 +1,22 @@
 import json
+import os
 import threading
 import time
 import uuid
-from typing import Any
+from typing import Any, List, Optional
 import traceback
 
 import pandas as pd
+import pyarrow as pa
 
+from app.SpilledFrame import SpilledFrame, should_spill
 from mosaicrs.pipeline.PipelineErrorHandling import PipelineStepError
 from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
 from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
 from mosaicrs.pipeline_steps.ChromaDataSource import ChromaDataSource
 from mosaicrs.pipeline_steps.CurlieFilterStep import CurlieFilterStep
 from mosaicrs.pipeline_steps.EmbeddingRerankerStep import EmbeddingRerankerStep
+from mosaicrs.pipeline_steps.HybridDataSource import HybridDataSource
 from mosaicrs.pipeline_steps.MeiliDataSource import MeiliDataSource
 from mosaicrs.pipeline_steps.MosaicDataSource import MosaicDataSource
 from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
@@ -36,6 +40,7 @@ pipeline_steps_mapping = {
     "mosaic_datasource": MosaicDataSource,
     "chroma_datasource": ChromaDataSource,
     "meili_datasource": MeiliDataSource,
+    "hybrid_datasource": HybridDataSource,
     "llm_summarizer": DocumentSummarizerStep,
     "all_results_summarizer": ResultsSummarizerStep,
     "embedding_reranker": EmbeddingRerankerStep,
@@ -54,6 +59,19 @@ pipeline_steps_mapping = {
     "curlie_filter": CurlieFilterStep,
 }
 
+# The intermediate results of the steps are not served by any endpoint, by default they are dropped once the task has finished.
+keep_history = os.environ.get('RESULT_KEEP_HISTORY', 'false').lower() == 'true'
+
+# Progress responses of spilled tasks contain at most this many documents, the complete result is served by /task/result.
+progress_page_size = int(os.environ.get('RESULT_PROGRESS_PAGE_SIZE', '1000'))
+
+_pipeline_info_ttl = float(os.environ.get('PIPELINE_INFO_TTL', '300'))
+_pipeline_info = None
+_pipeline_info_built_at = 0.0
+_pipeline_info_refreshing = False
+_pipeline_info_lock = threading.Lock()
+_pipeline_info_build_lock = threading.Lock()
+
 class PipelineTask:
     def __init__(self, pipeline):
         self.start_time = None
@@ -73,8 +91,6 @@ class PipelineTask:
         self.uuid = uuid.uuid4().hex
         self.thread = threading.Thread(target=_run_pipeline, args=(self.pipeline, self.thread_args))
 
-        self.final_df: pd.DataFrame = pd.DataFrame()
-
 
     def start(self):
         self.pipeline_handler.log('Executing pipeline with ID: ' + str(self.uuid))
@@ -106,12 +122,14 @@ class PipelineTask:
         result = None
         if self.thread_args['has_finished']:
             intermediate: PipelineIntermediate = self.thread_args['intermediate_data']
-
-            self.final_df = intermediate.documents
+            document_count = self.get_document_count()
+            # Reading a large spilled result on every poll would load it back into memory.
+            documents = self.get_documents(limit=progress_page_size if self.thread_args.get('spilled_documents') is not None else None)
 
             result = {
-                'data': intermediate.documents.to_json(orient='records'),
-                'result_description': f"Retrieved {len(intermediate.documents)} documents in {_format_seconds(self.thread_args['elapsed_time'])} seconds. {int(self.thread_args['cache_hit_ratio'] * 100)}% cache hits.",
+                'data': documents.to_json(orient='records'),
+                'total_documents': document_count,
+                'result_description': f"Retrieved {document_count} documents in {_format_seconds(self.thread_args['elapsed_time'])} seconds. {int(self.thread_args['cache_hit_ratio'] * 100)}% cache hits.",
                 'aggregated_data': intermediate.aggregated_data.to_json(orient='records'),
                 'metadata': intermediate.metadata.to_json(orient='records'),
             }
@@ -128,6 +146,57 @@ class PipelineTask:
         return data
 
 
+    def has_finished(self) -> bool:
+        return self.thread_args['has_finished']
+
+
+    def get_documents(self, columns: Optional[List[str]] = None, offset: int = 0, limit: Optional[int] = None) -> pd.DataFrame:
+        """
+            Returns (a page of) the final documents of a finished task. Large results are spilled to disk when the task finishes, in that case only the requested columns and rows are read from the memory-mapped file.
+        """
+
+        spilled_documents: Optional[SpilledFrame] = self.thread_args.get('spilled_documents')
+        if spilled_documents is not None:
+            return spilled_documents.read(columns=columns, offset=offset, limit=limit)
+
+        intermediate: PipelineIntermediate = self.thread_args['intermediate_data']
+        documents = intermediate.documents
+
+        if columns is not None:
+            documents = documents[columns]
+
+        if offset or limit is not None:
+            documents = documents.iloc[offset:None if limit is None else offset + limit]
+
+        return documents
+
+
+    def get_document_count(self) -> int:
+        spilled_documents: Optional[SpilledFrame] = self.thread_args.get('spilled_documents')
+        if spilled_documents is not None:
+            return len(spilled_documents)
+
+        return len(self.thread_args['intermediate_data'].documents)
+
+
+    def get_result_frame(self, part: str = 'documents', offset: int = 0, limit: Optional[int] = None) -> pd.DataFrame:
+        """
+            Returns one of the result frames of a finished task: 'documents', 'aggregated_data' or 'metadata'. Offset and limit only apply to the documents.
+        """
+
+        if part not in result_parts:
+            raise ValueError(f"Unknown result part '{part}'. Supported parts are: {', '.join(result_parts)}.")
+
+        if part == 'documents':
+            return self.get_documents(offset=offset, limit=limit)
+
+        intermediate: PipelineIntermediate = self.thread_args['intermediate_data']
+        return getattr(intermediate, part)
+
+
+result_parts = ['documents', 'aggregated_data', 'metadata']
+
+
 def _run_pipeline(pipeline, args):
     _start_time = time.time()
 
@@ -183,7 +252,7 @@ def _run_pipeline(pipeline, args):
         args['pipeline_progress'] = str(current_step_index) + '/' + str(total_steps)
         args['pipeline_percentage'] = current_step_index / total_steps
 
-        handler.reset(step_id)
+        handler.reset(step_id, cache_version=step.get_cache_version())
         try:
             data = step.transform(data, handler=handler)
         except PipelineStepError as e:
@@ -220,10 +289,33 @@ def _run_pipeline(pipeline, args):
     if pipeline_error_occured:
         data = PipelineIntermediate(query=query, arguments=parameters)
 
+    _spill_results(data, args, handler)
+
     args['intermediate_data'] = data
     args['has_finished'] = True
 
 
+def _spill_results(data: PipelineIntermediate, args, handler: PipelineStepHandler):
+    # Frames that cannot be written stay in memory, a failed spill must not keep the task from finishing.
+    if not keep_history:
+        data.history = {}
+
+    try:
+        if should_spill(data.documents):
+            args['spilled_documents'] = SpilledFrame(data.documents)
+            handler.log(f'Spilled {len(data.documents)} result documents to disk.')
+            data.documents = pd.DataFrame()
+    except (OSError, pa.ArrowException) as e:
+        handler.log(f'Could not spill results to disk, keeping them in memory: {e}')
+
+    for key, frame in data.history.items():
+        try:
+            if isinstance(frame, pd.DataFrame) and should_spill(frame):
+                data.history[key] = SpilledFrame(frame)
+        except (OSError, pa.ArrowException) as e:
+            handler.log(f'Could not spill the intermediate results of step {key} to disk, keeping them in memory: {e}')
+
+
 def _get_class_from_id_and_parameters(step_id: str, step_parameters: dict) -> PipelineStep:
     cls = pipeline_steps_mapping[step_id]
 
@@ -232,13 +324,50 @@ def _get_class_from_id_and_parameters(step_id: str, step_parameters: dict) -> Pi
     return instance
 
 def get_pipeline_info():
-    all_steps = {}
-    for k, v in pipeline_steps_mapping.items():
-        info = v.get_info()
+    """
+        Returns the JSON encoded step catalog. The catalog is built once and served from memory, after PIPELINE_INFO_TTL seconds it is rebuilt in a background thread while the previous one is still served, so dynamic parts like the MOSAIC index names are picked up without delaying requests.
+    """
+
+    global _pipeline_info_refreshing
+
+    with _pipeline_info_lock:
+        pipeline_info = _pipeline_info
+        refresh = (pipeline_info is not None and not _pipeline_info_refreshing
+                   and time.monotonic() - _pipeline_info_built_at >= _pipeline_info_ttl)
+        if refresh:
+            _pipeline_info_refreshing = True
+
+    if refresh:
+        threading.Thread(target=_build_pipeline_info, name='pipeline-info', daemon=True).start()
+
+    if pipeline_info is None:
+        with _pipeline_info_build_lock:
+            # Concurrent first requests wait for a single build.
+            pipeline_info = _pipeline_info if _pipeline_info is not None else _build_pipeline_info()
+
+    return pipeline_info
+
+
+def _build_pipeline_info() -> str:
+    global _pipeline_info, _pipeline_info_built_at, _pipeline_info_refreshing
+
+    try:
+        all_steps = {}
+        for k, v in pipeline_steps_mapping.items():
+            info = v.get_info()
+
+            all_steps[k] = info
+
+        pipeline_info = json.dumps(all_steps)
 
-        all_steps[k] = info
+        with _pipeline_info_lock:
+            _pipeline_info = pipeline_info
+            _pipeline_info_built_at = time.monotonic()
 
-    return json.dumps(all_steps)
+        return pipeline_info
+    finally:
+        with _pipeline_info_lock:
+            _pipeline_info_refreshing = False
 
 
 def _format_seconds(seconds):
@@ -0,0 +1,94 @@
+import os
+import uuid
+import pickle
+import weakref
+import tempfile
+from typing import List, Optional
+
+import pandas as pd
+import pyarrow as pa
+
+from app.result_formats import dataframe_to_table
+
+
+
+spill_directory = os.environ.get('RESULT_SPILL_DIR', os.path.join(tempfile.gettempdir(), 'mosaicrag-results'))
+spill_threshold_bytes = int(float(os.environ.get('RESULT_SPILL_THRESHOLD_MB', '32')) * 1024 * 1024)
+
+
+class SpilledFrame:
+
+    def __init__(self, df: pd.DataFrame, directory: str = spill_directory):
+        """
+            Writes a DataFrame to an uncompressed Arrow IPC file and keeps only a handle to it. Reads memory-map the file, so only the requested columns and rows are paged into memory and the resident size of a retained task stays bounded. Columns that Arrow cannot represent (e.g. lists in some rows and strings in others) are stored pickled, so the frame reads back with the same values. The file is deleted when the handle is garbage collected.
+
+            df: pd.DataFrame -> The frame to spill.\n
+            directory: str -> Directory for the spill files. Default: the `RESULT_SPILL_DIR` environment variable or a directory in the system temp folder.
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, uuid.uuid4().hex + '.arrow')
+
+        table, self.pickled_columns = dataframe_to_table(df, pickle_mixed_columns=True)
+        try:
+            with pa.OSFile(self.path, 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        except BaseException:
+            _remove_file(self.path)
+            raise
+
+        self.columns: List[str] = table.column_names
+        self.num_rows: int = table.num_rows
+        self.nbytes: int = table.nbytes
+
+        self._finalizer = weakref.finalize(self, _remove_file, self.path)
+
+
+    def __len__(self):
+        return self.num_rows
+
+
+    def read(self, columns: Optional[List[str]] = None, offset: int = 0, limit: Optional[int] = None) -> pd.DataFrame:
+        """
+            Reads (a part of) the spilled frame back into a DataFrame.
+
+            columns: list(str), optional -> Only read these columns. Default: all columns.\n
+            offset: int -> Index of the first row to read.\n
+            limit: int, optional -> Maximum number of rows to read. Default: all remaining rows.
+        """
+
+        with pa.memory_map(self.path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+
+            if columns is not None:
+                table = table.select(columns)
+
+            if offset or limit is not None:
+                table = table.slice(offset, limit)
+
+            df = table.to_pandas()
+
+        for column in self.pickled_columns:
+            if column in df:
+                df[column] = df[column].map(lambda value: None if value is None else pickle.loads(value))
+
+        return df
+
+
+    def delete(self):
+        self._finalizer()
+
+
+def should_spill(df: pd.DataFrame) -> bool:
+    if df.empty:
+        return False
+
+    return df.memory_usage(index=True, deep=True).sum() > spill_threshold_bytes
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
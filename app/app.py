@@ -20,13 +20,20 @@ import json
 
 from flask_cors import CORS
 from ollama import Client
-from sentence_transformers import SentenceTransformer
 
 from app.ConversationTask import ConversationTask
 from app.PipelineTask import get_pipeline_info, PipelineTask
+from app.result_formats import negotiate_mimetype, encode_dataframe
+from mosaicrs.pipeline.CacheBackend import CacheBackendError
+from mosaicrs.pipeline.EmbeddingModels import get_sentence_transformer
+from mosaicrs.pipeline.PipelineStepHandler import get_cache_usage, purge_cache, cache_statistics
+from mosaicrs.pipeline.RedisConnection import get_redis, is_redis_available, report_redis_failure
 
 import os
 import ssl
+import hmac
+import threading
+from typing import Optional
 
 
 # =========== Load Dependencies ===========
@@ -44,7 +51,8 @@ nltk.download("averaged_perceptron_tagger")
 nltk.download("wordnet")
 nltk.download('averaged_perceptron_tagger_eng')
 
-testmodel = SentenceTransformer("jinaai/jina-embeddings-v2-base-en")
+# Shared with the ChromaDataSource, which embeds queries in-process with this model (see CHROMA_EMBEDDING_BACKEND).
+testmodel = get_sentence_transformer("jinaai/jina-embeddings-v2-base-en", trust_remote_code=True)
 #Install spacy lemmatization models with python -m spacy download fr_core_news_sm
 
 
@@ -154,18 +162,14 @@ except (FileNotFoundError, ConnectionError, RuntimeError) as e:
 
 
 # ========= Redis Setup =========
-# Connect to Redis. Assumes Redis is running on localhost:6379.
-# For production, consider using environment variables for connection details.
-try:
-    redis_host = os.environ.get('REDIS_HOST', 'localhost')
+# Saved pipelines live in database 0 and share the process-wide connection pool with the step cache.
+# The connection is checked per request, so the routes recover on their own once redis is reachable again.
+redis_client = get_redis(db=0, decode_responses=True)
 
-    redis_client = redis.Redis(host=redis_host, port=6379, db=0, decode_responses=True)
-    # Ping the server to check the connection
-    redis_client.ping()
+if is_redis_available():
     logging.info("Successfully connected to Redis.")
-except redis.exceptions.ConnectionError as e:
-    logging.error(f"Could not connect to Redis: {e}. Pipeline save/restore will not work.")
-    redis_client = None
+else:
+    logging.error("Could not connect to Redis. Pipeline save/restore will not work until it is reachable.")
 
 client = Client(host=os.environ.get('OLLAMA_HOST', 'a'))  # Use your actual IP
 
@@ -196,6 +200,9 @@ except Exception as e:
 app = Flask(__name__)
 CORS(app)
 
+# Build the step catalog before the first request asks for it.
+threading.Thread(target=get_pipeline_info, name='pipeline-info', daemon=True).start()
+
 task_list: dict[str, PipelineTask] = {}
 conversation_list: dict[str, ConversationTask] = {}
 
@@ -292,7 +299,7 @@ def task_chat(chat_id: str):
 
 @app.post('/pipeline/save')
 def save_pipeline():
-    if not redis_client:
+    if not is_redis_available():
         print("Redis connection not available.")
         return Response("Service Unavailable: Redis connection not available.", status=503)
 
@@ -307,6 +314,7 @@ def save_pipeline():
     try:
         redis_client.set(redis_key, json.dumps(pipeline_config))
     except redis.exceptions.RedisError as e:
+        report_redis_failure()
         return Response("Internal Server Error: Could not save pipeline.", status=500)
 
     return Response(pipeline_id, mimetype='text/plain', status=201)
@@ -314,7 +322,7 @@ def save_pipeline():
 
 @app.get('/pipeline/restore/<string:pipeline_id>')
 def restore_pipeline(pipeline_id: str):
-    if not redis_client:
+    if not is_redis_available():
         return Response("Service Unavailable: Redis connection not available.", status=503)
 
     redis_key = f"pipeline:{pipeline_id}"
@@ -322,6 +330,7 @@ def restore_pipeline(pipeline_id: str):
     try:
         pipeline_config_json = redis_client.get(redis_key)
     except redis.exceptions.RedisError as e:
+        report_redis_failure()
         return Response("Internal Server Error: Could not retrieve pipeline.", status=500)
 
     if pipeline_config_json is None:
@@ -393,6 +402,44 @@ def task_progress(task_id: str):
 
     return response
 
+def _get_non_negative_int_arg(name: str, default: Optional[int]) -> Optional[int]:
+    if name not in request.args:
+        return default
+
+    value = request.args[name]
+    if not value.isdecimal():
+        raise ValueError(f"'{name}' must be a non-negative integer, got '{value}'.")
+
+    return int(value)
+
+@app.get('/task/result/<string:task_id>')
+def task_result(task_id: str):
+    if task_id not in task_list:
+        response = Response('Task id not found', 404)
+        return response
+
+    task = task_list[task_id]
+
+    if not task.has_finished():
+        return Response('Task has not finished yet', status=409)
+
+    mimetype = negotiate_mimetype(request.accept_mimetypes)
+    part = request.args.get('part', 'documents')
+
+    try:
+        offset = _get_non_negative_int_arg('offset', 0)
+        limit = _get_non_negative_int_arg('limit', None)
+        df = task.get_result_frame(part, offset=offset, limit=limit)
+    except ValueError as e:
+        return Response(str(e), status=400)
+
+    response = Response(
+        encode_dataframe(df, mimetype),
+        mimetype=mimetype)
+    response.vary.add('Accept')
+
+    return response
+
 @app.get('/task/cancel/<string:task_id>')
 def task_cancel(task_id: str):
     if task_id not in task_list:
@@ -410,3 +457,54 @@ def task_cancel(task_id: str):
         'Success',
         mimetype='text/plain')
     return response
+
+
+def _is_admin_request() -> bool:
+    # The app allows cross-origin requests, so the admin endpoints stay closed unless a token is configured.
+    admin_token = os.environ.get('ADMIN_API_TOKEN')
+    if not admin_token:
+        return False
+
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(), admin_token.encode())
+
+
+@app.get('/admin/cache')
+def admin_cache_usage():
+    if not _is_admin_request():
+        return Response('Forbidden', status=403)
+
+    try:
+        usage = get_cache_usage()
+    except CacheBackendError as e:
+        return Response(f"Service Unavailable: {e}", status=503)
+
+    return Response(
+        json.dumps(usage),
+        mimetype='application/json')
+
+
+@app.get('/admin/cache/stats')
+def admin_cache_statistics():
+    if not _is_admin_request():
+        return Response('Forbidden', status=403)
+
+    return Response(
+        json.dumps(cache_statistics.snapshot()),
+        mimetype='application/json')
+
+
+@app.delete('/admin/cache')
+@app.delete('/admin/cache/<string:step_id>')
+def admin_cache_purge(step_id: str = None):
+    if not _is_admin_request():
+        return Response('Forbidden', status=403)
+
+    try:
+        deleted = purge_cache(step_id, version=request.args.get('version'))
+    except CacheBackendError as e:
+        return Response(f"Service Unavailable: {e}", status=503)
+
+    logging.info(f"Purged {deleted} cache entries for step '{step_id or '*'}'")
+    return Response(
+        json.dumps({'deleted': deleted}),
+        mimetype='application/json')
@@ -0,0 +1,94 @@
+import io
+import pickle
+from typing import List, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+JSON_MIMETYPE = 'application/json'
+ARROW_STREAM_MIMETYPE = 'application/vnd.apache.arrow.stream'
+ARROW_FILE_MIMETYPE = 'application/vnd.apache.arrow.file'
+PARQUET_MIMETYPE = 'application/vnd.apache.parquet'
+
+supported_mimetypes = [JSON_MIMETYPE, ARROW_STREAM_MIMETYPE, ARROW_FILE_MIMETYPE, PARQUET_MIMETYPE]
+
+# Common aliases clients send for the binary formats.
+_mimetype_aliases = {
+    'application/x-parquet': PARQUET_MIMETYPE,
+    'application/parquet': PARQUET_MIMETYPE,
+    'application/x-apache-arrow-stream': ARROW_STREAM_MIMETYPE,
+}
+
+
+def negotiate_mimetype(accept_mimetypes) -> str:
+    """
+        Picks the result encoding for a request based on its Accept header. Falls back to JSON if the client does not ask for one of the binary formats.
+
+        accept_mimetypes: werkzeug MIMEAccept -> The parsed Accept header of the request (`request.accept_mimetypes`).
+
+        Returns one of the entries of `supported_mimetypes`.
+    """
+
+    best_match = accept_mimetypes.best_match(supported_mimetypes + list(_mimetype_aliases.keys()), default=JSON_MIMETYPE)
+    return _mimetype_aliases.get(best_match, best_match)
+
+
+def dataframe_to_table(df: pd.DataFrame, pickle_mixed_columns: bool = False) -> Tuple[pa.Table, List[str]]:
+    """
+        Converts a documents DataFrame into an Arrow table. Object columns with mixed value types (e.g. lists in some rows and strings in others) cannot be represented by a single Arrow type, those columns are converted instead of failing the whole conversion.
+
+        df: pd.DataFrame -> The frame to convert.\n
+        pickle_mixed_columns: bool -> Pickle the values of mixed columns, so they can be restored exactly (used for spilling). Default: False, the values are converted to strings, which every client can read.
+
+        Returns the table and the names of the converted columns.
+    """
+
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False), []
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        pass
+
+    convert = pickle.dumps if pickle_mixed_columns else str
+
+    df = df.copy()
+    converted_columns = []
+    for column in df.columns:
+        try:
+            pa.array(df[column], from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            df[column] = df[column].map(lambda value: None if value is None else convert(value))
+            converted_columns.append(column)
+
+    return pa.Table.from_pandas(df, preserve_index=False), converted_columns
+
+
+def encode_dataframe(df: pd.DataFrame, mimetype: str) -> bytes:
+    """
+        Encodes a DataFrame in the given result format.
+
+        df: pd.DataFrame -> The frame to encode, usually the documents of a finished task.\n
+        mimetype: str -> One of `supported_mimetypes`.
+
+        Returns the encoded bytes.
+    """
+
+    if mimetype == JSON_MIMETYPE:
+        return df.to_json(orient='records').encode()
+
+    table, _ = dataframe_to_table(df)
+    sink = io.BytesIO()
+
+    if mimetype == ARROW_STREAM_MIMETYPE:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    elif mimetype == ARROW_FILE_MIMETYPE:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    elif mimetype == PARQUET_MIMETYPE:
+        pq.write_table(table, sink, compression='zstd')
+    else:
+        raise ValueError(f"Unsupported result format '{mimetype}'. Supported formats are: {', '.join(supported_mimetypes)}.")
+
+    return sink.getvalue()
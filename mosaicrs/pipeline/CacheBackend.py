@@ -0,0 +1,68 @@
+from abc import ABC, abstractmethod
+from typing import List, Dict, Optional, Tuple, Iterator
+
+
+class CacheBackendError(Exception):
+    """
+        Raised by cache backends when the underlying store cannot be reached or fails. The PipelineStepHandler catches it and continues without the shared cache tier.
+    """
+    pass
+
+
+class CacheBackend(ABC):
+    """
+        Persistent, process-shared tier of the step cache (L2). Backends only store encoded bytes, compression, key layout and the in-process L1 cache are handled by the PipelineStepHandler. Keys use the glob-style pattern syntax of redis SCAN MATCH for reporting and purging.
+    """
+
+    name = ''
+
+    @abstractmethod
+    def is_available(self) -> bool:
+        pass
+
+    @abstractmethod
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        pass
+
+    @abstractmethod
+    def set_many(self, entries: Dict[str, bytes], ttl: int):
+        """
+            Stores all entries, ttl is the time to live in seconds, 0 keeps them forever.
+        """
+        pass
+
+    @abstractmethod
+    def get_many_with_type(self, keys: List[str]) -> List[Optional[Tuple[bytes, Optional[str]]]]:
+        pass
+
+    @abstractmethod
+    def set_many_with_type(self, entries: Dict[str, Tuple[bytes, Optional[str]]], ttl: int):
+        pass
+
+    @abstractmethod
+    def scan_sizes(self, pattern: str) -> Iterator[Tuple[str, int]]:
+        """
+            Yields (key, approximate size in bytes) for all keys matching the pattern.
+        """
+        pass
+
+    @abstractmethod
+    def delete_matching(self, pattern: str) -> int:
+        """
+            Deletes all keys matching the pattern and returns how many were deleted.
+        """
+        pass
+
+    @abstractmethod
+    def acquire_lease(self, key: str, owner: str, ttl: int) -> bool:
+        """
+            Atomically takes the lease on key for owner, unless another owner holds an unexpired lease. Returns whether the lease was taken.
+        """
+        pass
+
+    @abstractmethod
+    def release_lease(self, key: str, owner: str):
+        """
+            Releases the lease on key if it is still held by owner.
+        """
+        pass
@@ -0,0 +1,77 @@
+from threading import Lock
+from typing import Dict, Tuple
+
+
+_counter_names = ['lookups', 'hits', 'misses', 'hit_bytes', 'lookup_seconds', 'writes', 'written_bytes', 'computed_entries', 'compute_seconds']
+
+
+class CacheStatistics:
+
+    def __init__(self):
+        """
+            Thread-safe counters of cache effectiveness, broken down by step id and key namespace (e.g. 'full-text' or 'summary'). Besides hits and misses it records the time spent in lookups and the time spent computing the values of missed keys, which is used to estimate how much compute (or LLM) time the hits saved.
+        """
+
+        self._counters: Dict[Tuple[str, str], Dict[str, float]] = {}
+        self._lock = Lock()
+
+
+    def record_lookup(self, step_id: str, namespace: str, hits: int, misses: int, hit_bytes: int, seconds: float):
+        with self._lock:
+            counters = self._get_counters(step_id, namespace)
+            counters['lookups'] += hits + misses
+            counters['hits'] += hits
+            counters['misses'] += misses
+            counters['hit_bytes'] += hit_bytes
+            counters['lookup_seconds'] += seconds
+
+    def record_write(self, step_id: str, namespace: str, entries: int, written_bytes: int):
+        with self._lock:
+            counters = self._get_counters(step_id, namespace)
+            counters['writes'] += entries
+            counters['written_bytes'] += written_bytes
+
+    def record_compute(self, step_id: str, namespace: str, entries: int, seconds: float):
+        """
+            Records that computing `entries` missed values took `seconds` in total.
+        """
+
+        with self._lock:
+            counters = self._get_counters(step_id, namespace)
+            counters['computed_entries'] += entries
+            counters['compute_seconds'] += seconds
+
+
+    def snapshot(self) -> Dict[str, Dict[str, Dict[str, float]]]:
+        """
+            Returns the counters as {step_id: {namespace: {...}}}. Every namespace additionally reports its hit ratio, the mean lookup latency per key, the mean compute time per missed entry and the estimated time saved by all hits.
+        """
+
+        with self._lock:
+            items = [(key, dict(counters)) for key, counters in self._counters.items()]
+
+        report = {}
+        for (step_id, namespace), counters in items:
+            lookups = counters['lookups']
+            computed = counters['computed_entries']
+            mean_compute_seconds = counters['compute_seconds'] / computed if computed > 0 else 0.0
+
+            counters['hit_ratio'] = counters['hits'] / lookups if lookups > 0 else 0.0
+            counters['mean_lookup_ms'] = counters['lookup_seconds'] * 1000 / lookups if lookups > 0 else 0.0
+            counters['mean_compute_ms'] = mean_compute_seconds * 1000
+            counters['estimated_saved_seconds'] = counters['hits'] * mean_compute_seconds
+
+            report.setdefault(step_id, {})[namespace] = counters
+
+        return report
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+
+    def _get_counters(self, step_id: str, namespace: str) -> Dict[str, float]:
+        key = (step_id, namespace)
+        if key not in self._counters:
+            self._counters[key] = {name: 0 for name in _counter_names}
+        return self._counters[key]
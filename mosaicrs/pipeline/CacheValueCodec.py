@@ -0,0 +1,89 @@
+import os
+import zlib
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# First byte of every encoded value, tells the decoder how the rest was stored.
+_RAW = b'\x00'
+_ZSTD = b'\x01'
+_ZSTD_DICT = b'\x02'
+_ZLIB = b'\x03'
+
+
+class CacheValueCodec:
+
+    def __init__(self, min_bytes: int = 1024, level: int = 3, dictionary_path: Optional[str] = None):
+        """
+            Transparently compresses cache values before they are written to the cache backend. Values smaller than `min_bytes` are stored uncompressed, since compressing them costs more CPU than it saves memory. Uses zstd if the `zstandard` package is installed and falls back to zlib otherwise.
+
+            min_bytes: int -> Values with fewer UTF-8 bytes are stored raw.\n
+            level: int -> Compression level.\n
+            dictionary_path: str, optional -> Path to a zstd dictionary trained on typical cache values (see `scripts/train-cache-dictionary.py`). Dictionaries improve the ratio a lot for many small, similar values such as summaries.
+        """
+
+        self.min_bytes = min_bytes
+        self.level = level
+        self.dictionary = None
+
+        if dictionary_path and zstandard is not None:
+            with open(dictionary_path, 'rb') as f:
+                self.dictionary = zstandard.ZstdCompressionDict(f.read())
+            self.dictionary.precompute_compress(level=level)
+
+
+    def encode(self, value: str) -> bytes:
+        data = value.encode()
+
+        if len(data) < self.min_bytes:
+            return _RAW + data
+
+        if zstandard is None:
+            compressed, marker = zlib.compress(data, min(self.level, 9)), _ZLIB
+        elif self.dictionary is not None:
+            compressed, marker = zstandard.ZstdCompressor(level=self.level, dict_data=self.dictionary).compress(data), _ZSTD_DICT
+        else:
+            compressed, marker = zstandard.ZstdCompressor(level=self.level).compress(data), _ZSTD
+
+        if len(compressed) >= len(data):
+            return _RAW + data
+
+        return marker + compressed
+
+
+    def decode(self, data: Optional[bytes]) -> Optional[str]:
+        """
+            Decodes a value written by `encode`. Returns None if the value cannot be decoded, e.g. because it was compressed with a different dictionary, so the caller treats it as a cache miss.
+        """
+
+        if data is None:
+            return None
+
+        marker, payload = data[:1], data[1:]
+
+        try:
+            if marker == _RAW:
+                return payload.decode()
+            if marker == _ZSTD:
+                return zstandard.ZstdDecompressor().decompress(payload).decode()
+            if marker == _ZSTD_DICT:
+                return zstandard.ZstdDecompressor(dict_data=self.dictionary).decompress(payload).decode()
+            if marker == _ZLIB:
+                return zlib.decompress(payload).decode()
+
+            # Entries written before values were encoded are plain UTF-8.
+            return data.decode()
+        except Exception:
+            return None
+
+
+def codec_from_environment() -> CacheValueCodec:
+    return CacheValueCodec(
+        min_bytes=int(os.environ.get('CACHE_COMPRESSION_MIN_BYTES', '1024')),
+        level=int(os.environ.get('CACHE_COMPRESSION_LEVEL', '3')),
+        dictionary_path=os.environ.get('CACHE_COMPRESSION_DICT'),
+    )
@@ -0,0 +1,19 @@
+from threading import Lock
+from typing import Dict
+
+from sentence_transformers import SentenceTransformer
+
+
+_models: Dict[str, SentenceTransformer] = {}
+_models_lock = Lock()
+
+
+def get_sentence_transformer(model_name: str, trust_remote_code: bool = False) -> SentenceTransformer:
+    """
+        Returns the process-wide instance of the SentenceTransformer model. Models are loaded on first use and then shared by all steps, so a model preloaded at startup is not loaded a second time.
+    """
+
+    with _models_lock:
+        if model_name not in _models:
+            _models[model_name] = SentenceTransformer(model_name, trust_remote_code=trust_remote_code)
+        return _models[model_name]
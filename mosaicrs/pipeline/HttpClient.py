@@ -0,0 +1,186 @@
+import os
+import ssl
+import json
+import random
+import asyncio
+import threading
+from threading import Lock
+from typing import Optional, Tuple
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+_timeout_seconds = float(os.environ.get('HTTP_TIMEOUT', '30'))
+_connect_timeout_seconds = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '10'))
+_max_connections = int(os.environ.get('HTTP_MAX_CONNECTIONS', '100'))
+_max_connections_per_host = int(os.environ.get('HTTP_MAX_CONNECTIONS_PER_HOST', '32'))
+_retries = int(os.environ.get('HTTP_RETRIES', '3'))
+_verify_ssl = os.environ.get('HTTP_VERIFY_SSL', 'false').lower() == 'true'
+
+_retry_statuses = [429, 500, 502, 503, 504]
+
+# (connect, read) timeout for blocking requests.
+http_timeout = (_connect_timeout_seconds, _timeout_seconds)
+
+_lock = Lock()
+_session: Optional[requests.Session] = None
+_session_pid = None
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_pid = None
+_async_session: Optional[aiohttp.ClientSession] = None
+_ssl_context = None
+
+
+def get_http_session() -> requests.Session:
+    """
+        Returns the blocking HTTP session of this process. It keeps connections alive across tasks and retries idempotent requests on connection errors and 429/5xx responses with exponential backoff. Pass `timeout=http_timeout` to every request.
+    """
+
+    global _session, _session_pid
+
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            retry = Retry(total=_retries, backoff_factor=0.3, status_forcelist=_retry_statuses, allowed_methods=['GET', 'HEAD'], raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=_max_connections_per_host, max_retries=retry)
+
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session_pid = os.getpid()
+
+        return _session
+
+
+def run_async(coroutine):
+    """
+        Runs the coroutine on the HTTP event loop of this process and blocks until it is done. The loop lives in a background thread for the lifetime of the process, so the aiohttp session returned by `get_async_http_session` and its connection pool survive across tasks.
+    """
+
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop()).result()
+
+
+def get_async_http_session() -> aiohttp.ClientSession:
+    """
+        Returns the shared aiohttp session. Must only be used in coroutines started with `run_async`. Connections are pooled and kept alive, the number of concurrent connections is limited in total (HTTP_MAX_CONNECTIONS) and per host (HTTP_MAX_CONNECTIONS_PER_HOST).
+    """
+
+    global _async_session
+
+    if _async_session is None or _async_session.closed:
+        connector = aiohttp.TCPConnector(limit=_max_connections, limit_per_host=_max_connections_per_host, ssl=_get_ssl_context(),
+                                         keepalive_timeout=60, ttl_dns_cache=300)
+        _async_session = aiohttp.ClientSession(connector=connector,
+                                               timeout=aiohttp.ClientTimeout(total=_timeout_seconds, connect=_connect_timeout_seconds))
+
+    return _async_session
+
+
+async def fetch_text(url: str, params: Optional[dict] = None) -> str:
+    """
+        GETs the url with the shared session and returns the response body. Connection errors, timeouts and 429/5xx responses are retried up to HTTP_RETRIES times with exponential backoff and jitter, the last failure is raised.
+    """
+
+    return await _request_with_retries('GET', url, lambda response: response.text(), params=params)
+
+
+async def fetch_text_with_status(url: str, params: Optional[dict] = None) -> Tuple[int, str]:
+    """
+        Like `fetch_text`, but also returns the status code, so callers can tell error responses apart from results.
+    """
+
+    async def read(response: aiohttp.ClientResponse) -> Tuple[int, str]:
+        return response.status, await response.text()
+
+    return await _request_with_retries('GET', url, read, params=params)
+
+
+async def fetch_text_prefix(url: str, max_bytes: int, params: Optional[dict] = None) -> Tuple[str, bool]:
+    """
+        Like `fetch_text`, but reads the body in chunks and stops after max_bytes, the rest of the body is never buffered. Returns the (possibly cut) body and whether it was complete.
+    """
+
+    async def read(response: aiohttp.ClientResponse) -> Tuple[str, bool]:
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            body.extend(chunk)
+            if len(body) > max_bytes:
+                # A multi-byte character may be cut at the end.
+                return body[:max_bytes].decode(response.charset or 'utf-8', errors='ignore'), False
+
+        return body.decode(response.charset or 'utf-8', errors='replace'), True
+
+    return await _request_with_retries('GET', url, read, params=params)
+
+
+async def post_json(url: str, payload: dict, headers: Optional[dict] = None) -> dict:
+    """
+        POSTs the payload as JSON and returns the decoded JSON response, retried like `fetch_text`. Only use it for idempotent requests like searches. Other error responses raise aiohttp.ClientResponseError, its message holds the response body.
+    """
+
+    async def read(response: aiohttp.ClientResponse) -> str:
+        body = await response.text()
+        if response.status >= 400:
+            raise _ResponseError(response.request_info, response.history, status=response.status, message=body)
+        return body
+
+    try:
+        return json.loads(await _request_with_retries('POST', url, read, json=payload, headers=headers))
+    except _ResponseError as e:
+        raise aiohttp.ClientResponseError(e.request_info, e.history, status=e.status, message=e.message) from None
+
+
+class _ResponseError(Exception):
+    # Error responses that must not be retried, raised past the retry loop.
+    def __init__(self, request_info, history, status: int, message: str):
+        super().__init__(status, message)
+        self.request_info = request_info
+        self.history = history
+        self.status = status
+        self.message = message
+
+
+async def _request_with_retries(method: str, url: str, read, **kwargs):
+    session = get_async_http_session()
+
+    for attempt in range(_retries + 1):
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status in _retry_statuses and attempt < _retries:
+                    raise aiohttp.ClientResponseError(response.request_info, response.history, status=response.status)
+                return await read(response)
+        except _ResponseError:
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt >= _retries:
+                raise
+            await asyncio.sleep(0.3 * (2 ** attempt) * (0.5 + random.random()))
+
+
+def _get_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_pid, _async_session
+
+    with _lock:
+        # A forked worker inherits the loop object, but not the thread running it.
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            _async_session = None
+            threading.Thread(target=_loop.run_forever, name='http-event-loop', daemon=True).start()
+
+        return _loop
+
+
+def _get_ssl_context():
+    global _ssl_context
+
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+        if not _verify_ssl:
+            _ssl_context.check_hostname = False
+            _ssl_context.verify_mode = ssl.CERT_NONE
+
+    return _ssl_context
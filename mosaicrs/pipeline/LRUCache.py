@@ -0,0 +1,111 @@
+import sys
+import time
+import fnmatch
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Optional
+
+
+class LRUCache:
+
+    def __init__(self, max_bytes: int):
+        """
+            Thread-safe in-process cache, bounded by the approximate size of the stored values in bytes. When the limit is exceeded, the least recently used entries are evicted first. Entries may have a time to live, expired entries are dropped when they are looked up.
+
+            max_bytes: int -> Upper bound for the summed size of all entries. A value of 0 disables the cache.
+        """
+
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.evictions = 0
+
+        self._entries: OrderedDict[str, Any] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._expires_at: dict[str, float] = {}
+        self._lock = Lock()
+
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+
+            if key in self._expires_at and self._expires_at[key] <= time.monotonic():
+                self._remove(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+
+    def put(self, key: str, value: Any, ttl: Optional[float] = None):
+        """
+            Stores the value, ttl is the time to live in seconds. None or 0 keeps the entry until it is evicted.
+        """
+
+        size = _estimate_size(key, value)
+
+        # Entries that would flush most of the cache on their own are not worth keeping.
+        if size > self.max_bytes // 4:
+            self.delete(key)
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._sizes[key]
+
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._sizes[key] = size
+            self.current_bytes += size
+
+            if ttl:
+                self._expires_at[key] = time.monotonic() + ttl
+            else:
+                self._expires_at.pop(key, None)
+
+            while self.current_bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+
+    def delete(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+
+    def delete_matching(self, pattern: str):
+        """
+            Deletes all entries whose key matches the glob-style pattern (same syntax as redis SCAN MATCH).
+        """
+
+        with self._lock:
+            for key in [key for key in self._entries if fnmatch.fnmatchcase(key, pattern)]:
+                self._remove(key)
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._expires_at.clear()
+            self.current_bytes = 0
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def _remove(self, key: str):
+        # Callers hold the lock.
+        del self._entries[key]
+        self.current_bytes -= self._sizes.pop(key)
+        self._expires_at.pop(key, None)
+
+
+def _estimate_size(key: str, value: Any) -> int:
+    if isinstance(value, tuple):
+        return sys.getsizeof(key) + sum(sys.getsizeof(item) for item in value)
+
+    return sys.getsizeof(key) + sys.getsizeof(value)
@@ -47,6 +47,8 @@ class WarningMessages(Enum):
     TooLargeKValue = ("K-VALUE TOO LARGE", "The selected number of remaining rows after reduction is larger than the current result set. The number of remaining results is therefore set to the overall number of existing results (k={k}).")
     SentimentPredictionNotPossible = ("SENITMENT PREDICTION NOT POSSIBLE" , "The sentiment prediction with the model '{model}' failed with the exception '{exception_name}'. The input string was: {input}")
     MetricDoesNotExist = ("METRIC DOES NOT EXIST", "The selected metric does not exist, therefore we use Cosine Similarity per default.")
+    RowProcessingFailed = ("ROW PROCESSING FAILED", "{step}: {count} rows could not be processed and were left empty. The first failure was the exception '{exception_name}': {exception}")
+    DataSourceFailed = ("DATA SOURCE FAILED", "The data source '{source}' failed with the exception '{exception_name}': {exception}. The results contain only the documents of the other sources.")
 
 class PipelineStepWarning():
     def __init__(self, message, **kwargs):
@@ -1,9 +1,75 @@
 from threading import Lock
-import redis
+from typing import List, Dict, Optional, Tuple
 import os
+import json
+import time
 import datetime
+import uuid
 
+from mosaicrs.pipeline.CacheBackend import CacheBackend, CacheBackendError
+from mosaicrs.pipeline.CacheStatistics import CacheStatistics
+from mosaicrs.pipeline.CacheValueCodec import codec_from_environment
+from mosaicrs.pipeline.LRUCache import LRUCache
 from mosaicrs.pipeline.PipelineErrorHandling import PipelineStepWarning
+from mosaicrs.pipeline.RedisCacheBackend import RedisCacheBackend
+from mosaicrs.pipeline.RedisConnection import is_redis_available
+from mosaicrs.pipeline.SQLiteCacheBackend import SQLiteCacheBackend
+
+
+_typed_entry_suffix = ':row'
+
+# All step cache keys have the layout '<prefix>:<step_id>:<version>:<key>', so the entries of one step (or one version of it) can be reported and purged together.
+cache_key_prefix = 'mosaicrs-cache'
+lease_key_prefix = 'mosaicrs-lease'
+_cache_version = os.environ.get('CACHE_VERSION', '1')
+
+# The step cache lives in its own redis database, so it can never evict or purge the pipelines saved by /pipeline/save.
+_cache_db = int(os.environ.get('REDIS_CACHE_DB', '1'))
+
+# Time to live of cache entries in seconds, 0 keeps entries forever. CACHE_STEP_TTLS overrides it per step id, e.g. '{"mosaic_datasource": 86400}'.
+_default_ttl = int(os.environ.get('CACHE_DEFAULT_TTL', str(7 * 24 * 60 * 60)))
+_step_ttls: Dict[str, int] = json.loads(os.environ.get('CACHE_STEP_TTLS', '{}'))
+
+# Persistent L2 tier: 'redis' (shared by all hosts), 'sqlite' (a local file shared by the workers of one host) or 'auto' (redis if it is reachable when the first handler is created, sqlite otherwise).
+_cache_backend_name = os.environ.get('CACHE_BACKEND', 'redis').lower()
+_sqlite_cache_path = os.environ.get('CACHE_SQLITE_PATH', os.path.join('cache', 'mosaicrs-cache.sqlite3'))
+_cache_backend: Optional[CacheBackend] = None
+_cache_backend_lock = Lock()
+
+# A lease on a key announces that one task is computing its value, so concurrent tasks wait for the result instead of computing it again. Leases expire after CACHE_LEASE_TTL seconds, so the lease of a crashed worker does not block others for long, and waiting gives up after CACHE_LEASE_WAIT seconds.
+_lease_ttl = int(os.environ.get('CACHE_LEASE_TTL', '120'))
+_lease_wait_seconds = float(os.environ.get('CACHE_LEASE_WAIT', '300'))
+
+# In-process L1 cache in front of the L2 backend, shared by all handlers (and therefore all tasks) of this worker. Its entries expire with the TTL of their step.
+_l1_cache = LRUCache(max_bytes=int(float(os.environ.get('CACHE_L1_MAX_MB', '64')) * 1024 * 1024))
+
+# A purge can only clear the L1 cache of the worker that handles it. It also writes a new purge generation to the backend, every worker compares it at the start of each step and clears its L1 cache when it changed.
+_purge_generation_key = 'mosaicrs-purge-generation'
+_seen_purge_generation: Optional[bytes] = None
+_purge_generation_lock = Lock()
+
+# Cache effectiveness of all tasks of this worker, per step id and key namespace, reported by GET /admin/cache/stats.
+cache_statistics = CacheStatistics()
+
+# Values are compressed before they are written to the L2 backend, the L1 cache keeps them decompressed.
+_codec = codec_from_environment()
+
+
+def get_cache_backend() -> CacheBackend:
+    """
+        Returns the L2 cache backend of this process, selected by CACHE_BACKEND. The backend is created on first use and shared by all handlers.
+    """
+
+    global _cache_backend
+
+    with _cache_backend_lock:
+        if _cache_backend is None:
+            if _cache_backend_name == 'sqlite' or (_cache_backend_name == 'auto' and not is_redis_available()):
+                _cache_backend = SQLiteCacheBackend(_sqlite_cache_path)
+            else:
+                _cache_backend = RedisCacheBackend(db=_cache_db)
+
+        return _cache_backend
 
 
 class PipelineStepHandler:
@@ -13,9 +79,26 @@ class PipelineStepHandler:
         self.progress = (0, 0)
         self.progress_lock = Lock()
         self.step_id = ''
+        self.cache_version = _cache_version
+        self.cache_ttl = _default_ttl
 
         self.cache_hits = 0
         self.cache_misses = 0
+        self.l1_hits = 0
+        self.l1_misses = 0
+        self.l2_hits = 0
+        self.l2_misses = 0
+
+        self.uncompressed_bytes = 0
+        self.compressed_bytes = 0
+        self.compression_seconds = 0.0
+        self.decompression_seconds = 0.0
+
+        # Per step and namespace statistics of this task, the same numbers are added to the worker-wide `cache_statistics`.
+        self.statistics = CacheStatistics()
+        self._miss_times: Dict[str, float] = {}
+
+        self.lease_owner = uuid.uuid4().hex
 
         self.log_cache_requests = False
 
@@ -29,17 +112,13 @@ class PipelineStepHandler:
 
         self.error = (0, '')
 
+        self.cache_backend = get_cache_backend()
+        self.caching_enabled = self.cache_backend.is_available()
 
-        redis_host = os.environ.get('REDIS_HOST', 'localhost')
-        try:
-            self.redis = redis.Redis(host=redis_host, port=6379, db=0, decode_responses=True)
-            if self.redis.ping():
-                self.caching_enabled = True
-                self.log("Initializing PipelineStepHandler with caching enabled")
-
-        except redis.ConnectionError:
-            self.caching_enabled = False
-            self.log("Could not connect to redis, disabling caching...")
+        if self.caching_enabled:
+            self.log("Initializing PipelineStepHandler with caching enabled ({})".format(self.cache_backend.name))
+        else:
+            self.log("Could not connect to the {} cache, disabling caching...".format(self.cache_backend.name))
 
 
     def update_progress(self, current_iteration, total_iterations):
@@ -75,39 +154,269 @@ class PipelineStepHandler:
 
         return data
 
-    def reset(self, step_id: str):
+    def reset(self, step_id: str, cache_version: str = ''):
         self.should_cancel = False
         self.progress = (0, 0)
         self.step_id = step_id
+        self.cache_version = _cache_version + ('.' + cache_version if cache_version else '')
+        self.cache_ttl = _step_ttls.get(str(step_id), _default_ttl)
 
+        # The cache backend may have come back (or gone away) since the last step.
+        self.caching_enabled = self.cache_backend.is_available()
+        self._miss_times.clear()
 
-    def put_cache(self, key: str, value: str):
-        if not self.caching_enabled:
-            return
+        if self.caching_enabled:
+            self._sync_purge_generation()
+
+    def _cache_key(self, key: str) -> str:
+        return '{}:{}:{}:{}'.format(cache_key_prefix, self.step_id, self.cache_version, key)
 
-        if value is None:
-            value = ''
 
+    def put_cache(self, key: str, value: str, namespace: str = 'default'):
         if key is None:
             return
 
-        self.redis.set(self.step_id + key, value)
+        self.put_many({key: value}, namespace=namespace)
+
+    def get_cache(self, key: str, namespace: str = 'default'):
+        return self.get_many([key], namespace=namespace)[0]
+
+
+    def get_many(self, keys: List[str], namespace: str = 'default') -> List[Optional[str]]:
+        """
+            Bulk version of `get_cache`. Looks up all keys in the in-process cache first and fetches the remaining ones from the cache backend in a single round trip. Returns the values in the same order, None for every miss. The namespace (e.g. 'full-text' or 'summary') only groups the cache statistics, it is not part of the key.
+        """
+
+        return self._get_many_tiered([self._cache_key(key) for key in keys], self._backend_get_many, namespace)
+
+    def put_many(self, entries: Dict[str, Optional[str]], namespace: str = 'default', ttl: Optional[int] = None):
+        """
+            Bulk version of `put_cache`. Writes all entries to the in-process cache and to the cache backend in a single round trip. The time since the last lookup with misses in the same namespace is recorded as the compute time of the written entries. ttl overrides the time to live of the step, both the in-process cache and the cache backend expire the entries after it.
+        """
+
+        entries = {self._cache_key(key): value if value is not None else '' for key, value in entries.items() if key is not None}
+        if len(entries) == 0:
+            return
+
+        for full_key, value in entries.items():
+            _l1_cache.put(full_key, value, self.cache_ttl if ttl is None else ttl)
+
+        if self.caching_enabled:
+            encoded = {full_key: self._encode(value) for full_key, value in entries.items()}
+            self._execute_backend(self.cache_backend.set_many, encoded, self.cache_ttl if ttl is None else ttl)
+
+        self._record_write(namespace, list(entries.values()))
+
+        if self.log_cache_requests:
+            self.log('Caching {} entries'.format(len(entries)))
+
+    def get_many_with_type(self, keys: List[str], namespace: str = 'default') -> List[Optional[Tuple[str, Optional[str]]]]:
+        """
+            Fetches entries written by `put_many_with_type`, backend lookups happen in a single round trip. Value and column type of an entry are stored together, so a hit returns both as a tuple (value, column_type). Misses are None.
+        """
+
+        return self._get_many_tiered([self._cache_key(key) + _typed_entry_suffix for key in keys], self._backend_get_many_with_type, namespace)
+
+    def put_many_with_type(self, entries: Dict[str, Tuple[Optional[str], Optional[str]]], namespace: str = 'default'):
+        """
+            Writes (value, column_type) tuples in a single round trip, see `get_many_with_type`.
+        """
+
+        entries = {
+            self._cache_key(key) + _typed_entry_suffix: (value if value is not None else '', column_type)
+            for key, (value, column_type) in entries.items() if key is not None
+        }
+        if len(entries) == 0:
+            return
+
+        for full_key, entry in entries.items():
+            _l1_cache.put(full_key, entry, self.cache_ttl)
+
+        if self.caching_enabled:
+            encoded = {full_key: (self._encode(value), column_type) for full_key, (value, column_type) in entries.items()}
+            self._execute_backend(self.cache_backend.set_many_with_type, encoded, self.cache_ttl)
+
+        self._record_write(namespace, [value for value, _ in entries.values()])
+
+        if self.log_cache_requests:
+            self.log('Caching {} entries'.format(len(entries)))
+
+    def _get_many_tiered(self, full_keys: List[str], get_many_l2, namespace: str) -> List:
+        if len(full_keys) == 0:
+            return []
+
+        start = time.perf_counter()
+
+        values = [_l1_cache.get(full_key) for full_key in full_keys]
+        missing_indices = [i for i, value in enumerate(values) if value is None]
+
+        self.l1_hits += len(full_keys) - len(missing_indices)
+        self.l1_misses += len(missing_indices)
+
+        if self.caching_enabled and len(missing_indices) > 0:
+            l2_values = self._execute_backend(get_many_l2, [full_keys[i] for i in missing_indices])
+            if l2_values is None:
+                l2_values = [None for _ in missing_indices]
+            l2_hits = 0
+
+            for i, value in zip(missing_indices, l2_values):
+                if value is not None:
+                    values[i] = value
+                    # The remaining lifetime in the backend is unknown, the step TTL is an upper bound.
+                    _l1_cache.put(full_keys[i], value, self.cache_ttl)
+                    l2_hits += 1
+
+            self.l2_hits += l2_hits
+            self.l2_misses += len(missing_indices) - l2_hits
+
+        hits = sum(1 for value in values if value is not None)
+        self.cache_hits += hits
+        self.cache_misses += len(values) - hits
+
+        end = time.perf_counter()
+        hit_bytes = sum(len(value[0] if isinstance(value, tuple) else value) for value in values if value is not None)
+        for statistics in (self.statistics, cache_statistics):
+            statistics.record_lookup(self.step_id, namespace, hits, len(values) - hits, hit_bytes, end - start)
+
+        if hits < len(values):
+            self._miss_times[namespace] = end
+
         if self.log_cache_requests:
-            self.log('Caching: {}'.format(key))
+            self.log('Requesting cache: {} keys - {} HITS'.format(len(values), hits))
+
+        return values
+
+    def acquire_lease(self, key: str) -> bool:
+        """
+            Tries to take the lease on a key missed by `get_many` before computing its value. Returns True if the caller should compute the value, i.e. it holds the lease or leases are not available because caching is disabled. Returns False if another task is computing the value or has written it since the lookup, use `wait_for_many` to get it. Release the lease with `release_lease` after writing the value.
+        """
 
-    def get_cache(self, key: str):
         if not self.caching_enabled:
+            return True
+
+        acquired = self._execute_backend(self.cache_backend.acquire_lease, self._lease_key(key), self.lease_owner, _lease_ttl)
+        if acquired is None:
+            return True
+        if not acquired:
+            return False
+
+        # The previous owner may have written the value and released its lease between our lookup and now.
+        full_key = self._cache_key(key)
+        if _l1_cache.get(full_key) is not None or (self._execute_backend(self.cache_backend.get_many, [full_key]) or [None])[0] is not None:
+            self.release_lease(key)
+            return False
+
+        return True
+
+    def release_lease(self, key: str):
+        if self.caching_enabled:
+            self._execute_backend(self.cache_backend.release_lease, self._lease_key(key), self.lease_owner)
+
+    def wait_for_many(self, keys: List[str], namespace: str = 'default', timeout: Optional[float] = None) -> List[Optional[str]]:
+        """
+            Waits for the values of keys whose leases are held by other tasks, polling with a growing delay. Returns the values in the same order. None means that the caller has to compute the value itself: either the other lease expired or was released without a value (the caller then holds the lease), or the wait timed out or was cancelled.
+        """
+
+        full_keys = [self._cache_key(key) for key in keys]
+        values: List[Optional[str]] = [None for _ in keys]
+        pending = list(range(len(keys)))
+        deadline = time.monotonic() + (timeout if timeout is not None else _lease_wait_seconds)
+        delay = 0.05
+
+        while len(pending) > 0 and self.caching_enabled and not self.should_cancel:
+            for i in pending:
+                values[i] = _l1_cache.get(full_keys[i])
+
+            missing = [i for i in pending if values[i] is None]
+            if len(missing) > 0:
+                l2_values = self._execute_backend(self._backend_get_many, [full_keys[i] for i in missing])
+                for i, value in zip(missing, l2_values or []):
+                    if value is not None:
+                        values[i] = value
+                        _l1_cache.put(full_keys[i], value, self.cache_ttl)
+
+            # A lease that can be taken again was released without a value or has expired.
+            pending = [i for i in pending if values[i] is None and not self.acquire_lease(keys[i])]
+
+            if len(pending) == 0 or time.monotonic() >= deadline:
+                break
+
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+        waited_hits = sum(1 for value in values if value is not None)
+        if waited_hits > 0:
+            self.log('Reused {} results computed by concurrent tasks'.format(waited_hits))
+
+        return values
+
+    def _lease_key(self, key: str) -> str:
+        return '{}:{}:{}:{}'.format(lease_key_prefix, self.step_id, self.cache_version, key)
+
+    def _record_write(self, namespace: str, values: List[str]):
+        written_bytes = sum(len(value) for value in values)
+        miss_time = self._miss_times.get(namespace)
+        now = time.perf_counter()
+
+        for statistics in (self.statistics, cache_statistics):
+            statistics.record_write(self.step_id, namespace, len(values), written_bytes)
+            if miss_time is not None:
+                statistics.record_compute(self.step_id, namespace, len(values), now - miss_time)
+
+        # Entries written one by one are each measured from the previous write.
+        if miss_time is not None:
+            self._miss_times[namespace] = now
+
+    def _sync_purge_generation(self):
+        global _seen_purge_generation
+
+        generation = (self._execute_backend(self.cache_backend.get_many, [_purge_generation_key]) or [None])[0]
+
+        with _purge_generation_lock:
+            if generation != _seen_purge_generation:
+                # Another worker purged (a part of) the cache, its entries may still be in our L1 cache.
+                _l1_cache.clear()
+                _seen_purge_generation = generation
+
+    def _execute_backend(self, command, *args):
+        """
+            Runs a cache backend command. If the backend fails, caching is disabled for the rest of the step instead of failing the pipeline, the next step checks again.
+        """
+
+        try:
+            return command(*args)
+        except CacheBackendError as e:
+            self.caching_enabled = False
+            self.log('{} cache error, disabling caching for this step: {}'.format(self.cache_backend.name, e))
             return None
 
-        if self.redis.exists(self.step_id + key):
-            if self.log_cache_requests:
-                self.log('Requesting cache: {} - HIT'.format(key))
-            self.cache_hits += 1
-            return self.redis.get(self.step_id + key)
-        self.cache_misses += 1
-        if self.log_cache_requests:
-            self.log('Requesting cache: {} - MISS'.format(key))
-        return None
+    def _backend_get_many(self, full_keys: List[str]) -> List[Optional[str]]:
+        return [self._decode(value) for value in self.cache_backend.get_many(full_keys)]
+
+    def _backend_get_many_with_type(self, full_keys: List[str]) -> List[Optional[Tuple[str, Optional[str]]]]:
+        entries = []
+        for entry in self.cache_backend.get_many_with_type(full_keys):
+            entries.append(None if entry is None else (self._decode(entry[0]), entry[1]))
+
+        return entries
+
+    def _encode(self, value: str) -> bytes:
+        start = time.perf_counter()
+        data = _codec.encode(value)
+        self.compression_seconds += time.perf_counter() - start
+
+        self.uncompressed_bytes += len(value.encode())
+        self.compressed_bytes += len(data)
+        return data
+
+    def _decode(self, data: Optional[bytes]) -> Optional[str]:
+        if data is None:
+            return None
+
+        start = time.perf_counter()
+        value = _codec.decode(data)
+        self.decompression_seconds += time.perf_counter() - start
+        return value
 
 
     def log(self, message: str):
@@ -122,13 +431,79 @@ class PipelineStepHandler:
             print(f'[WARNING] in {self.step_id}' + warning.warning_msg)
 
 
-    def get_cache_hit_ratio(self):
-        if self.caching_enabled:
-            if (self.cache_misses + self.cache_hits) == 0:
-                return 0
-            return float(self.cache_hits) / float(self.cache_misses + self.cache_hits)
-        return 0
+    def get_cache_hit_ratio(self, tier: Optional[str] = None):
+        """
+            Returns the ratio of cache hits to all cache lookups. Use tier='l1' for the in-process cache, tier='l2' for the cache backend and None for both tiers combined.
+        """
+
+        hits, misses = {
+            None: (self.cache_hits, self.cache_misses),
+            'l1': (self.l1_hits, self.l1_misses),
+            'l2': (self.l2_hits, self.l2_misses),
+        }[tier]
+
+        if (hits + misses) == 0:
+            return 0
+        return float(hits) / float(hits + misses)
 
     def log_cache_statistics(self):
-        if self.caching_enabled:
-            self.log('Cache statistics: {} hits | {} misses'.format(self.cache_hits, self.cache_misses))
+        self.log('Cache statistics: {} hits | {} misses (L1: {} hits | {} misses, L2: {} hits | {} misses)'.format(
+            self.cache_hits, self.cache_misses, self.l1_hits, self.l1_misses, self.l2_hits, self.l2_misses))
+
+        if self.compressed_bytes > 0:
+            self.log('Cache compression: {} -> {} bytes (ratio {:.2f}), {:.1f} ms compressing | {:.1f} ms decompressing'.format(
+                self.uncompressed_bytes, self.compressed_bytes, self.get_compression_ratio(),
+                self.compression_seconds * 1000, self.decompression_seconds * 1000))
+
+        # Hits of this task are valued with the mean compute time observed by the whole worker, since a task that only hits the cache never measures it.
+        worker_statistics = cache_statistics.snapshot()
+        for step_id, namespaces in self.statistics.snapshot().items():
+            for namespace, counters in namespaces.items():
+                mean_compute_ms = worker_statistics.get(step_id, {}).get(namespace, counters)['mean_compute_ms']
+                self.log('Cache {} / {}: {} hits | {} misses, {:.1f} ms lookup, ~{:.1f} s compute saved'.format(
+                    step_id, namespace, counters['hits'], counters['misses'], counters['lookup_seconds'] * 1000, counters['hits'] * mean_compute_ms / 1000))
+
+    def get_compression_ratio(self):
+        if self.compressed_bytes == 0:
+            return 1.0
+        return float(self.uncompressed_bytes) / float(self.compressed_bytes)
+
+
+def get_cache_usage() -> Dict[str, Dict[str, int]]:
+    """
+        Reports the number of keys and their approximate size in bytes per step id and cache version, e.g. {'llm_summarizer': {'keys': 120, 'bytes': 483210, 'versions': {...}}}. Scans the whole cache backend, so it is meant for admin use only. Raises CacheBackendError if the backend is unreachable.
+    """
+
+    usage = {}
+
+    for key, size in get_cache_backend().scan_sizes(cache_key_prefix + ':*'):
+        _, step_id, version = key.split(':', 3)[:3]
+        step_usage = usage.setdefault(step_id, {'keys': 0, 'bytes': 0, 'versions': {}})
+        step_usage['keys'] += 1
+        step_usage['bytes'] += size
+        step_usage['versions'][version] = step_usage['versions'].get(version, 0) + 1
+
+    return usage
+
+
+def purge_cache(step_id: Optional[str] = None, version: Optional[str] = None) -> int:
+    """
+        Deletes the cache entries of one step id (optionally only of one cache version) or, if no step id is given, of all steps. Returns the number of deleted backend entries. The other workers clear their L1 cache at the start of their next step, see `_purge_generation_key`. Raises CacheBackendError if the backend is unreachable.
+    """
+
+    global _seen_purge_generation
+
+    pattern = ':'.join([cache_key_prefix, step_id if step_id else '*', version if version else '*', '*'])
+    backend = get_cache_backend()
+
+    deleted = backend.delete_matching(pattern)
+
+    # The generation is changed after the entries are gone, so no worker can pick a purged entry up again after clearing its L1 cache.
+    generation = uuid.uuid4().hex.encode()
+    backend.set_many({_purge_generation_key: generation}, 0)
+
+    with _purge_generation_lock:
+        _l1_cache.delete_matching(pattern)
+        _seen_purge_generation = generation
+
+    return deleted
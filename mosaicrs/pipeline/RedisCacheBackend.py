@@ -0,0 +1,112 @@
+from typing import List, Dict, Optional, Tuple, Iterator
+
+import redis
+
+from mosaicrs.pipeline.CacheBackend import CacheBackend, CacheBackendError
+from mosaicrs.pipeline.RedisConnection import get_redis, is_redis_available, report_redis_failure
+
+
+# Deletes the lease only if it still belongs to the caller, so an owner whose lease expired cannot release the lease of the next owner.
+_release_lease_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisCacheBackend(CacheBackend):
+
+    name = 'redis'
+
+    def __init__(self, db: int):
+        """
+            Stores the step cache in a redis database, shared by all workers and hosts that use the same redis instance. Plain entries are strings, typed entries are hashes with the fields 'value' and 'column_type'. Commands of one call are sent in a single round trip.
+
+            db: int -> Redis database of the step cache, see REDIS_CACHE_DB.
+        """
+
+        self.client = get_redis(db=db, decode_responses=False)
+        self._release_script = self.client.register_script(_release_lease_script)
+
+
+    def is_available(self) -> bool:
+        return is_redis_available()
+
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        return self._execute(self.client.mget, keys)
+
+    def set_many(self, entries: Dict[str, bytes], ttl: int):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in entries.items():
+            pipeline.set(key, value, ex=ttl if ttl > 0 else None)
+        self._execute(pipeline.execute)
+
+    def get_many_with_type(self, keys: List[str]) -> List[Optional[Tuple[bytes, Optional[str]]]]:
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.hmget(key, 'value', 'column_type')
+
+        entries = []
+        for value, column_type in self._execute(pipeline.execute):
+            if value is None:
+                entries.append(None)
+            else:
+                entries.append((value, column_type.decode() if column_type else None))
+
+        return entries
+
+    def set_many_with_type(self, entries: Dict[str, Tuple[bytes, Optional[str]]], ttl: int):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, (value, column_type) in entries.items():
+            pipeline.hset(key, mapping={
+                'value': value,
+                'column_type': column_type if column_type is not None else '',
+            })
+            if ttl > 0:
+                pipeline.expire(key, ttl)
+        self._execute(pipeline.execute)
+
+
+    def scan_sizes(self, pattern: str) -> Iterator[Tuple[str, int]]:
+        keys = self._execute(lambda: list(self.client.scan_iter(match=pattern, count=1000)))
+
+        for i in range(0, len(keys), 1000):
+            batch = keys[i:i + 1000]
+            pipeline = self.client.pipeline(transaction=False)
+            for key in batch:
+                pipeline.memory_usage(key)
+
+            for key, size in zip(batch, self._execute(pipeline.execute)):
+                yield key.decode(), size or 0
+
+    def delete_matching(self, pattern: str) -> int:
+        deleted = 0
+        batch = []
+
+        for key in self._execute(lambda: list(self.client.scan_iter(match=pattern, count=1000))):
+            batch.append(key)
+            if len(batch) >= 1000:
+                deleted += self._execute(self.client.unlink, *batch)
+                batch = []
+
+        if batch:
+            deleted += self._execute(self.client.unlink, *batch)
+
+        return deleted
+
+
+    def acquire_lease(self, key: str, owner: str, ttl: int) -> bool:
+        return bool(self._execute(lambda: self.client.set(key, owner, nx=True, ex=ttl)))
+
+    def release_lease(self, key: str, owner: str):
+        self._execute(lambda: self._release_script(keys=[key], args=[owner]))
+
+
+    def _execute(self, command, *args):
+        try:
+            return command(*args)
+        except redis.RedisError as e:
+            report_redis_failure()
+            raise CacheBackendError(str(e)) from e
@@ -0,0 +1,98 @@
+import os
+import time
+from threading import Lock
+from typing import Dict, Tuple
+
+import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
+
+
+_redis_host = os.environ.get('REDIS_HOST', 'localhost')
+_redis_port = int(os.environ.get('REDIS_PORT', '6379'))
+
+_pool_options = {
+    'host': _redis_host,
+    'port': _redis_port,
+    'max_connections': int(os.environ.get('REDIS_MAX_CONNECTIONS', '64')),
+    'socket_connect_timeout': 2,
+    'socket_timeout': 5,
+    'health_check_interval': 30,
+    # Pooled connections take their retry settings from the pool, the same arguments are ignored by a client created with a pool.
+    'retry': Retry(ExponentialBackoff(cap=1.0, base=0.05), 2),
+    'retry_on_error': [redis.ConnectionError, redis.TimeoutError],
+}
+
+# Once redis is found unreachable it is only pinged again after an exponentially growing delay, so an outage costs one failed ping per backoff window instead of one per cache request.
+_min_backoff_seconds = 1.0
+_max_backoff_seconds = 60.0
+
+_pools: Dict[Tuple[int, bool], redis.ConnectionPool] = {}
+_pools_lock = Lock()
+
+_health_lock = Lock()
+_available = None
+_next_check_time = 0.0
+_backoff_seconds = _min_backoff_seconds
+
+
+def get_redis(db: int = 0, decode_responses: bool = True) -> redis.Redis:
+    """
+        Returns a client for the given redis database that uses the process-wide connection pool. Clients are cheap, the pool keeps the connections alive across tasks and reconnects transparently. Individual commands are retried with exponential backoff.
+    """
+
+    key = (db, decode_responses)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = redis.ConnectionPool(db=db, decode_responses=decode_responses, **_pool_options)
+        pool = _pools[key]
+
+    return redis.Redis(connection_pool=pool)
+
+
+def is_redis_available() -> bool:
+    """
+        Returns whether redis is reachable. The result is cached: after a failure redis is pinged again only after the backoff delay, after a success it is trusted until `report_redis_failure` is called.
+    """
+
+    global _available, _next_check_time
+
+    with _health_lock:
+        if _available is not None and (_available or time.monotonic() < _next_check_time):
+            return _available
+
+    try:
+        reachable = get_redis().ping()
+    except redis.RedisError:
+        reachable = False
+
+    if reachable:
+        _report_redis_success()
+    else:
+        report_redis_failure()
+
+    return reachable
+
+
+def report_redis_failure():
+    """
+        Marks redis as unavailable until the backoff delay has passed. Called whenever a cache command fails.
+    """
+
+    global _available, _next_check_time, _backoff_seconds
+
+    with _health_lock:
+        if _available is False and time.monotonic() < _next_check_time:
+            return
+
+        _next_check_time = time.monotonic() + _backoff_seconds
+        _backoff_seconds = min(_backoff_seconds * 2, _max_backoff_seconds)
+        _available = False
+
+
+def _report_redis_success():
+    global _available, _backoff_seconds
+
+    with _health_lock:
+        _available = True
+        _backoff_seconds = _min_backoff_seconds
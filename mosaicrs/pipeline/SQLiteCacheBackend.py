@@ -0,0 +1,155 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Optional, Tuple, Iterator
+
+from mosaicrs.pipeline.CacheBackend import CacheBackend, CacheBackendError
+
+
+# SQLite limits the number of bound parameters per statement.
+_max_keys_per_query = 500
+
+# Expired entries are not returned by lookups and are physically deleted every this many writes.
+_writes_per_cleanup = 2000
+
+
+class SQLiteCacheBackend(CacheBackend):
+
+    name = 'sqlite'
+
+    def __init__(self, path: str, busy_timeout: float = 10.0):
+        """
+            Stores the step cache in a local SQLite database file, so single-node deployments keep their cache across restarts without running redis. The database runs in WAL mode, which lets all gunicorn workers on the host read concurrently while one of them writes. Every thread (and every forked worker) opens its own connection.
+
+            path: str -> Path of the database file, missing directories are created.\n
+            busy_timeout: float -> Seconds a writer waits for the lock held by another worker before giving up.
+        """
+
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.available = True
+
+        self._local = threading.local()
+        self._writes_lock = threading.Lock()
+        self._writes_since_cleanup = 0
+
+        try:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+
+            connection = self._connection()
+            connection.execute('CREATE TABLE IF NOT EXISTS cache_entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, column_type TEXT, expires_at REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_entries_expires_at ON cache_entries (expires_at)')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache_leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)')
+        except (OSError, sqlite3.Error) as e:
+            print('Could not open the cache database {}: {}'.format(path, e))
+            self.available = False
+
+
+    def is_available(self) -> bool:
+        return self.available
+
+
+    def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        rows = self._select(keys)
+        return [rows[key][0] if key in rows else None for key in keys]
+
+    def set_many(self, entries: Dict[str, bytes], ttl: int):
+        self.set_many_with_type({key: (value, None) for key, value in entries.items()}, ttl)
+
+    def get_many_with_type(self, keys: List[str]) -> List[Optional[Tuple[bytes, Optional[str]]]]:
+        rows = self._select(keys)
+        return [(rows[key][0], rows[key][1] or None) if key in rows else None for key in keys]
+
+    def set_many_with_type(self, entries: Dict[str, Tuple[bytes, Optional[str]]], ttl: int):
+        expires_at = time.time() + ttl if ttl > 0 else None
+        self._write('INSERT OR REPLACE INTO cache_entries (key, value, column_type, expires_at) VALUES (?, ?, ?, ?)',
+                    [(key, value, column_type, expires_at) for key, (value, column_type) in entries.items()])
+
+        with self._writes_lock:
+            self._writes_since_cleanup += len(entries)
+            cleanup = self._writes_since_cleanup >= _writes_per_cleanup
+            if cleanup:
+                self._writes_since_cleanup = 0
+
+        if cleanup:
+            self._write('DELETE FROM cache_entries WHERE expires_at < ?', [(time.time(),)])
+
+
+    def scan_sizes(self, pattern: str) -> Iterator[Tuple[str, int]]:
+        rows = self._execute('SELECT key, length(key) + length(value) FROM cache_entries WHERE key GLOB ? AND (expires_at IS NULL OR expires_at > ?)',
+                             (pattern, time.time()))
+        for key, size in rows:
+            yield key, size
+
+    def delete_matching(self, pattern: str) -> int:
+        return self._write('DELETE FROM cache_entries WHERE key GLOB ?', [(pattern,)])
+
+
+    def acquire_lease(self, key: str, owner: str, ttl: int) -> bool:
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM cache_leases WHERE key = ? AND expires_at <= ?', (key, now))
+            return connection.execute('INSERT OR IGNORE INTO cache_leases (key, owner, expires_at) VALUES (?, ?, ?)',
+                                      (key, owner, now + ttl)).rowcount == 1
+
+    def release_lease(self, key: str, owner: str):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM cache_leases WHERE key = ? AND owner = ?', (key, owner))
+
+
+    def _select(self, keys: List[str]) -> Dict[str, Tuple[bytes, Optional[str]]]:
+        rows = {}
+        now = time.time()
+
+        for i in range(0, len(keys), _max_keys_per_query):
+            batch = keys[i:i + _max_keys_per_query]
+            query = 'SELECT key, value, column_type FROM cache_entries WHERE key IN ({}) AND (expires_at IS NULL OR expires_at > ?)'.format(
+                ', '.join('?' for _ in batch))
+
+            for key, value, column_type in self._execute(query, (*batch, now)):
+                rows[key] = (value, column_type)
+
+        return rows
+
+    def _execute(self, query: str, parameters: tuple) -> List[tuple]:
+        try:
+            return self._connection().execute(query, parameters).fetchall()
+        except sqlite3.Error as e:
+            raise CacheBackendError(str(e)) from e
+
+    def _write(self, query: str, rows: List[tuple]) -> int:
+        with self._transaction() as connection:
+            return connection.executemany(query, rows).rowcount
+
+    @contextmanager
+    def _transaction(self):
+        """
+            Runs the enclosed statements in one write transaction. BEGIN IMMEDIATE takes the write lock up front, so concurrent writers wait for busy_timeout instead of failing halfway through.
+        """
+
+        try:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            raise CacheBackendError(str(e)) from e
+
+    def _connection(self) -> sqlite3.Connection:
+        # Connections must not be shared across threads or carried over into forked workers.
+        pid, connection = getattr(self._local, 'connection', (None, None))
+        if connection is not None and pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        self._local.connection = (os.getpid(), connection)
+        return connection
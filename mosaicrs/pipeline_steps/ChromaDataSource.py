@@ -1,52 +1,164 @@
 import os
+import re
+import json
+import asyncio
+import hashlib
+from threading import Lock
+from typing import Dict, List
 
 import chromadb
 import ollama
 import pandas as pd
+from mosaicrs.pipeline.EmbeddingModels import get_sentence_transformer
+from mosaicrs.pipeline.HttpClient import run_async, post_json
 from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
 from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
 from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
+from mosaicrs.pipeline_steps.utils import truncate_text, truncated_column, deduplicate
 
 OLLAMA_URL = f"http://{os.environ.get('OLLAMA_HOST', 'localhost:11434')}"
 
+# 'ollama' embeds queries with the Ollama instance, 'local' with the same model loaded in-process by sentence-transformers.
+_default_embedding_backend = os.environ.get('CHROMA_EMBEDDING_BACKEND', 'ollama').lower()
+
+# Rank offset of reciprocal rank fusion, 60 is the value of the original paper.
+_rrf_k = 60
+
+# Chunked collections return several chunks of the same page, so more results than the limit are requested.
+_chunk_overfetch = max(1, int(os.environ.get('CHROMA_CHUNK_OVERFETCH', '3')))
+_max_chunk_overfetch = 16
+
+# Ollama embedding models and the sentence-transformers models with the same weights.
+_local_embedding_models = {
+    'jina/jina-embeddings-v2-base-en': 'jinaai/jina-embeddings-v2-base-en',
+    'mxbai-embed-large': 'mixedbread-ai/mxbai-embed-large-v1',
+    'nomic-embed-text': 'nomic-ai/nomic-embed-text-v1.5',
+}
+
+# Clients and collections are shared by all steps of a process, so a search does not pay for connection setup.
+_clients_lock = Lock()
+_chroma_clients = {}
+_chroma_collections = {}
+_ollama_clients: Dict[str, ollama.Client] = {}
+
+_pull_lock = Lock()
+_pulled_models = set()
+
+
+def _get_chroma_collection(host: str, port: int, name: str):
+    with _clients_lock:
+        if (host, port) not in _chroma_clients:
+            _chroma_clients[(host, port)] = chromadb.HttpClient(host=host, port=port)
+        if (host, port, name) not in _chroma_collections:
+            _chroma_collections[(host, port, name)] = _chroma_clients[(host, port)].get_collection(name=name)
+        return _chroma_collections[(host, port, name)]
+
+
+def _discard_chroma_collection(host: str, port: int, name: str):
+    with _clients_lock:
+        _chroma_collections.pop((host, port, name), None)
+
+
+def _get_ollama_client(url: str, model: str) -> ollama.Client:
+    """
+        Returns the shared client for the Ollama instance. The model is pulled once per process, the first time it is used, instead of before every query.
+    """
+
+    with _clients_lock:
+        if url not in _ollama_clients:
+            _ollama_clients[url] = ollama.Client(host=url)
+        client = _ollama_clients[url]
+
+    with _pull_lock:
+        if (url, model) not in _pulled_models:
+            # A failed pull is not remembered, so it is retried with the next query.
+            client.pull(model)
+            _pulled_models.add((url, model))
+
+    return client
+
+
 class ChromaDataSource(PipelineStep):
-    def _get_ollama_embedding(self, query: str) -> list[float]:
-        client = ollama.Client(
-            host=OLLAMA_URL
-        )
+    def _get_query_embeddings(self, queries: List[str], handler: PipelineStepHandler) -> List[List[float]]:
+        """
+            Embeds the queries with the embedding model of this step, either through Ollama or in-process. Queries missing in the cache are embedded in one batch by the local model. The Ollama embeddings API that built the collection only takes one prompt per request, so with Ollama every missing query is sent as its own request, all of them concurrently. Embeddings are cached per backend, model and query (ignoring surrounding and repeated whitespace), in process and in the step cache, so repeated searches skip the model.
+        """
+
+        local_model = self._get_local_model_name()
+        backend = 'local' if local_model is not None else 'ollama'
+
+        cache_keys = ['query-embedding-{}'.format(hashlib.sha1('{}\n{}\n{}'.format(backend, self.ollama_model, query).encode()).hexdigest()) for query in queries]
+        embeddings = [json.loads(cached) if cached is not None else None for cached in handler.get_many(cache_keys, namespace='query-embedding')]
+
+        missing_indices = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if len(missing_indices) < len(queries):
+            handler.log('Reusing {} cached query embeddings'.format(len(queries) - len(missing_indices)))
+        if len(missing_indices) == 0:
+            return embeddings
+
+        missing_queries = [queries[i] for i in missing_indices]
+        if local_model is not None:
+            model = get_sentence_transformer(local_model, trust_remote_code=True)
+            computed = [embedding.tolist() for embedding in model.encode(missing_queries)]
+            handler.log(f'Generated {len(computed)} query embeddings in-process using model: {local_model}')
+        else:
+            _get_ollama_client(self.ollama_url, self.ollama_model)
+            computed = run_async(self._embed_with_ollama(missing_queries))
+            handler.log(f'Generated {len(computed)} query embeddings using Ollama model: {self.ollama_model}')
 
-        client.pull('jina/jina-embeddings-v2-base-en')
+        for i, embedding in zip(missing_indices, computed):
+            embeddings[i] = embedding
 
-        data = client.embeddings(model='jina/jina-embeddings-v2-base-en',
-                                 prompt=query).embedding
+        handler.put_many({cache_keys[i]: json.dumps(embeddings[i]) for i in missing_indices}, namespace='query-embedding')
 
-        return list(data)
+        return embeddings
+
+    async def _embed_with_ollama(self, queries: List[str]) -> List[List[float]]:
+        # The collection was built with /api/embeddings (scripts/generate-embeddings.py), which does not normalise the vectors like the batched /api/embed does.
+        url = '{}/api/embeddings'.format(self.ollama_url.rstrip('/'))
+        responses = await asyncio.gather(*[post_json(url, {'model': self.ollama_model, 'prompt': query}) for query in queries])
+        return [list(response['embedding']) for response in responses]
+
+    def _get_local_model_name(self):
+        if self.embedding_backend != 'local':
+            return None
+
+        return _local_embedding_models.get(self.ollama_model.split(':')[0])
 
 
     def __init__(self, output_column: str = 'full_text', limit='10',
                  embedding_model='jina/jina-embeddings-v2-base-en:latest', chromadb_url='dallions:80', # chromadb_url='172.17.0.1:8000',
-                 chromadb_collection='curlie_eng'):
+                 chromadb_collection='curlie_eng', embedding_backend: str = _default_embedding_backend,
+                 additional_queries: str = '', fusion: str = 'rrf', aggregate_chunks: str = 'max'):
         self.target_column_name = output_column
         self.limit = int(limit)
 
-        CHROMA_HOST = chromadb_url.split(':')[0]
-        CHROMA_PORT = int(chromadb_url.split(':')[1])
-        CHROMA_COLLECTION_NAME = chromadb_collection
+        # Alternative formulations of the query, separated by semicolons or line breaks.
+        self.additional_queries = [query for query in re.split(r'[;\n]', additional_queries or '') if query.strip()]
+        self.fusion = fusion
+        self.aggregate_chunks = aggregate_chunks
+
+        self.chroma_host = chromadb_url.split(':')[0]
+        self.chroma_port = int(chromadb_url.split(':')[1])
+        self.chroma_collection_name = chromadb_collection
 
-        self.client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
-        self.collection = self.client.get_collection(name=CHROMA_COLLECTION_NAME)
+        self.collection = _get_chroma_collection(self.chroma_host, self.chroma_port, self.chroma_collection_name)
 
         self.ollama_model = embedding_model
         self.ollama_url = OLLAMA_URL
+        self.embedding_backend = embedding_backend
+
+        if self.embedding_backend == 'local' and self._get_local_model_name() is None:
+            print('No in-process equivalent of the embedding model {}, using Ollama.'.format(embedding_model))
 
     def transform(self, data: PipelineIntermediate,
-                  handler: PipelineStepHandler = PipelineStepHandler()) -> PipelineIntermediate:
+                  handler: PipelineStepHandler) -> PipelineIntermediate:
 
         handler.update_progress(0, 1)
 
-        query_text = data.query
+        queries, _ = deduplicate([' '.join(query.split()) for query in [data.query] + self.additional_queries])
 
-        chroma_documents = self.query_chromadb_to_dataframe(query_text, handler)
+        chroma_documents = self.query_chromadb_to_dataframe(queries, handler)
 
         handler.log('merging chroma documents with existing documents...')
         handler.log('chroma columns: ' + str(chroma_documents.columns))
@@ -58,49 +170,124 @@ class ChromaDataSource(PipelineStep):
         handler.log(str(data.documents.head()))
 
         data.set_text_column('full-text')
-        data.set_rank_column('chromadb_distance')
+        # The fused order only differs from the distance order for several queries or summed chunk scores.
+        data.set_rank_column('chromadb_distance' if len(queries) == 1 and self.aggregate_chunks != 'sum' else 'chromadb_fused_rank')
         data.set_chip_column('curlielabels_en')
         # data.set_chip_column('curlielabels')
 
         handler.increment_progress()
         return data
 
-    def query_chromadb_to_dataframe(self, query: str, handler: PipelineStepHandler) -> pd.DataFrame:
-        handler.log("Starting embedding of query with Ollama...")
+    def query_chromadb_to_dataframe(self, queries: List[str], handler: PipelineStepHandler) -> pd.DataFrame:
+        """
+            Searches the collection for all queries with a single request. With several queries the result lists are fused by `fusion` ('rrf' for reciprocal rank fusion, 'max' for the best score of each document), documents found by several queries are kept once and the fused order is stored in the column 'chromadb_fused_rank'. Chunks of the same page (metadata id '{id}_{chunk}') are aggregated into one document according to `aggregate_chunks`, the text of its best chunk is stored in the column 'passage'. The search over-fetches and is repeated with more results until `limit` distinct documents are found or the collection is exhausted.
+        """
 
+        handler.log("Starting embedding of {} queries...".format(len(queries)))
 
-        query_embedding = self._get_ollama_embedding(query)
-        handler.log(f'Generated query embedding using Ollama model: {self.ollama_model}')
-        handler.log("Finished embedding, starting query, emb[:5]: " + str(query_embedding[:5]))
+        query_embeddings = self._get_query_embeddings(queries, handler)
+        handler.log("Finished embedding, starting query, emb[:5]: " + str(query_embeddings[0][:5]))
 
-        search_result = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=self.limit
-        )
-        handler.log("Finished query, nr of results: " + str(len(search_result.get('ids'))))
+        n_results = self.limit * (_chunk_overfetch if self.aggregate_chunks != 'none' else 1)
+        while True:
+            search_result = self._query_collection(query_embeddings, n_results)
+            returned = max([len(ids) for ids in search_result.get('ids') or []], default=0)
+            handler.log("Finished query, nr of results: " + str(sum(len(ids) for ids in search_result.get('ids') or [])))
+
+            documents = self._aggregate(self._to_hits(search_result))
 
-        ids = search_result.get('ids', [[]])[0]
-        metadatas = search_result.get('metadatas', [[]])[0]
-        distances = search_result.get('distances', [[]])[0]
+            if len(documents) >= self.limit or returned < n_results or n_results >= self.limit * _max_chunk_overfetch:
+                break
 
-        if not ids:
+            n_results *= 2
+            handler.log('Found {} distinct documents, searching again with {} results per query'.format(len(documents), n_results))
+
+        if documents.empty:
             handler.log('no results from chromadb')
             return pd.DataFrame()
 
-        data_for_df = [
-            {
+        data_for_df = []
+        for fused_rank, (parent_id, document) in enumerate(documents.head(self.limit).iterrows()):
+            meta = document['meta']
+            text, truncated = truncate_text(meta.get('plain_text'))
+            data_for_df.append({
                 **meta,
-                'full-text': meta.get('plain_text'),
-                'chromadb_distance': dist,
-                'id': doc_id,
-            }
-            for doc_id, meta, dist in zip(ids, metadatas, distances)
-        ]
+                'plain_text': text,
+                'full-text': text,
+                truncated_column: truncated,
+                'passage': meta.get('chunk_text', text),
+                'parent_id': parent_id,
+                'chromadb_distance': document['distance'],
+                'chromadb_fused_rank': fused_rank + 1,
+                'id': document['doc_id'],
+            })
 
         df = pd.DataFrame(data_for_df)
         handler.log('returning df from chromadb query with length: ' + str(len(df)))
         return df
 
+    def _query_collection(self, query_embeddings: List[List[float]], n_results: int) -> dict:
+        try:
+            return self.collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results
+            )
+        except Exception:
+            # The pooled collection may be stale, e.g. after it was re-created. Fetch it again and retry once.
+            _discard_chroma_collection(self.chroma_host, self.chroma_port, self.chroma_collection_name)
+            self.collection = _get_chroma_collection(self.chroma_host, self.chroma_port, self.chroma_collection_name)
+            return self.collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results
+            )
+
+    def _to_hits(self, search_result: dict) -> pd.DataFrame:
+        rows = []
+        for query_index, (ids, metadatas, distances) in enumerate(zip(search_result.get('ids') or [], search_result.get('metadatas') or [], search_result.get('distances') or [])):
+            for rank, (doc_id, meta, dist) in enumerate(zip(ids, metadatas, distances)):
+                rows.append((query_index, rank, doc_id, meta or {}, dist))
+
+        hits = pd.DataFrame(rows, columns=['query', 'rank', 'doc_id', 'meta', 'distance'])
+
+        if self.aggregate_chunks == 'none':
+            hits['parent_id'] = hits['doc_id']
+        else:
+            # Chunks carry the id of their page with the chunk index appended, pages that were not chunked keep their id.
+            page_ids = hits['meta'].map(lambda meta: meta.get('id')).fillna(hits['doc_id']).astype(str)
+            hits['parent_id'] = page_ids.str.replace(r'_\d+$', '', regex=True)
+
+        return hits
+
+    def _aggregate(self, hits: pd.DataFrame) -> pd.DataFrame:
+        """
+            Groups the hits of all queries by page and returns one row per page (index parent_id) with the fused score, the best distance and the id and metadata of the best chunk, sorted by score.
+        """
+
+        if hits.empty:
+            return pd.DataFrame(columns=['score', 'distance', 'doc_id', 'meta'])
+
+        hits = hits.assign(chunk_score=1.0 / (1.0 + hits['distance']))
+
+        # Score of every page per query: its best chunk or all of its chunks.
+        per_query = hits.groupby(['query', 'parent_id']).agg(
+            score=('chunk_score', 'sum' if self.aggregate_chunks == 'sum' else 'max'),
+            distance=('distance', 'min'),
+        )
+
+        if self.fusion == 'max':
+            per_query['fused'] = per_query['score']
+        else:
+            per_query['fused'] = 1.0 / (_rrf_k + per_query.groupby(level='query')['score'].rank(method='first', ascending=False))
+
+        documents = per_query.groupby(level='parent_id').agg(
+            score=('fused', 'max' if self.fusion == 'max' else 'sum'),
+            distance=('distance', 'min'),
+        )
+
+        best_chunks = hits.sort_values('distance').drop_duplicates('parent_id').set_index('parent_id')[['doc_id', 'meta']]
+
+        return documents.join(best_chunks).sort_values(['score', 'distance'], ascending=[False, True])
+
     @staticmethod
     def get_info() -> dict:
         return {
@@ -126,6 +313,40 @@ class ChromaDataSource(PipelineStep):
                     'supported-values': ['jina/jina-embeddings-v2-base-en:latest', 'mxbai-embed-large', 'nomic-embed-text'],
                     'default': 'jina/jina-embeddings-v2-base-en:latest',
                 },
+                'embedding_backend': {
+                    'title': 'Embedding backend',
+                    'description': 'Where the query is embedded: "ollama" calls the Ollama instance, "local" runs the same model inside the server process, which avoids a network round trip.',
+                    'type': 'dropdown',
+                    'enforce-limit': True,
+                    'required': True,
+                    'supported-values': ['ollama', 'local'],
+                    'default': _default_embedding_backend,
+                },
+                'additional_queries': {
+                    'title': 'Additional queries',
+                    'description': 'Alternative formulations of the query, separated by semicolons. All queries are searched with one request and their results are fused. Optional.',
+                    'type': 'string',
+                    'required': False,
+                    'default': '',
+                },
+                'fusion': {
+                    'title': 'Result fusion',
+                    'description': 'How the results of several queries are combined: "rrf" (reciprocal rank fusion) rewards documents found by several queries, "max" ranks every document by its best distance.',
+                    'type': 'dropdown',
+                    'enforce-limit': True,
+                    'required': True,
+                    'supported-values': ['rrf', 'max'],
+                    'default': 'rrf',
+                },
+                'aggregate_chunks': {
+                    'title': 'Chunk aggregation',
+                    'description': 'How chunks of the same page are combined into one result: "max" scores a page by its best chunk, "sum" by all of its chunks, "none" keeps every chunk as a separate result.',
+                    'type': 'dropdown',
+                    'enforce-limit': True,
+                    'required': True,
+                    'supported-values': ['max', 'sum', 'none'],
+                    'default': 'max',
+                },
                 'chromadb_collection': {
                     'title': 'Collection',
                     'description': 'Name of the ChromaDB collection to query.',
@@ -5,10 +5,15 @@ from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
 from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
 from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
 from mosaicrs.pipeline_steps.RowProcessorPipelineStep import RowProcessorPipelineStep
-from typing import Optional
+from typing import List, Optional, Tuple
 
 
 class ContentExtractorStep(RowProcessorPipelineStep):
+
+    # Main content extraction is CPU bound and holds the GIL, so rows are extracted in parallel processes. Every process task receives a batch of rows, so pickling the step and starting the task is paid once per batch. Small batches keep all processes busy for typical result sets.
+    concurrency = 'process'
+    batch_size = 8
+
     def __init__(self, input_column: str, output_column: str):
         """
             Extracts the main content from full-text documents, removing non-essential elements like navigation menus or filler content. It extracts these elements from the text using the Resiliparse python library, which implements a rule-based main content extraction, which removes elements such as navigation blocks, sidebars, footers, ads and as far as possible aslo invisible elements. It used the text data from the `input_column` and saves the cleaned text data in the `output_column` of the PipelineIntermediate.
@@ -45,6 +50,13 @@ class ContentExtractorStep(RowProcessorPipelineStep):
 
         return re.sub(r"\n(\n)+",r"\n\n",cleaned_text), "text" 
 
+    def transform_rows(self, batch: List, handler) -> List[Tuple[any, Optional[str]]]:
+        """
+            Extracts the content of a batch of rows in one process task, see `transform_row`.
+        """
+
+        return [self.transform_row(data, handler) for data in batch]
+
 
     @staticmethod
     def get_info() -> dict:
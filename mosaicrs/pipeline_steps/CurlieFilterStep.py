@@ -12,7 +12,7 @@ class CurlieFilterStep(PipelineStep):
         self.filter_mode = filter_mode
 
     def transform(self, data: PipelineIntermediate,
-                  handler: PipelineStepHandler = PipelineStepHandler()) -> PipelineIntermediate:
+                  handler: PipelineStepHandler) -> PipelineIntermediate:
         documents = data.documents
 
         if self.curlie_column not in documents.columns:
@@ -11,6 +11,7 @@ from mosaicrs.llm.LLMInterface import LLMInterface
 from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
 from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
 from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
+from mosaicrs.pipeline_steps.utils import deduplicate, log_deduplication
 from enum import Enum
 
 document_summarizer_prompt = """
@@ -48,7 +49,7 @@ class DocumentSummarizerStep(PipelineStep):
         self.summarize_prompt = document_summarizer_prompt
 
 
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()):
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler):
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step. Apply the summarization step to the given pipeline data.
             
@@ -62,31 +63,59 @@ class DocumentSummarizerStep(PipelineStep):
             raise err.PipelineStepError(err.ErrorMessages.InvalidColumnName, column=self.source_column_name)
         
         full_texts = [entry if entry is not None else "" for entry in data.documents[self.source_column_name].to_list()]
-        summarized_texts = []
+
+        # Every unique text is summarized once, which directly saves paid LLM calls for duplicated pages and empty texts.
+        full_texts, inverse = deduplicate(full_texts)
+        log_deduplication(handler, self.get_name(), inverse, full_texts)
 
         handler.update_progress(0, len(full_texts))
 
-        for text in tqdm(full_texts):
+        text_hashes = [hashlib.sha1((text + self.model_name + self.summarize_prompt).encode()).hexdigest() for text in full_texts]
+        summarized_texts = handler.get_many(text_hashes, namespace='summary')
+        leased_elsewhere = []
+
+        for i, (text, text_hash) in enumerate(tqdm(zip(full_texts, text_hashes), total=len(full_texts))):
             if handler.should_cancel:
                 break
 
-            text_hash = hashlib.sha1((text + self.model_name + self.summarize_prompt).encode()).hexdigest()
-            summary = handler.get_cache(text_hash)
+            if summarized_texts[i] is None:
+                # Documents that a concurrent task is already summarizing are collected and awaited after the own work is done.
+                if not handler.acquire_lease(text_hash):
+                    leased_elsewhere.append(i)
+                    continue
 
-            if summary is None:
-                summary = self.llm.generate(self.summarize_prompt + text, self.model_name)
-                handler.put_cache(text_hash, summary)
+                summarized_texts[i] = self._summarize(text, text_hash, handler)
 
-            summarized_texts.append(summary)
             handler.increment_progress()
 
-        data.documents[self.target_column_name] = summarized_texts
+        if leased_elsewhere and not handler.should_cancel:
+            awaited_summaries = handler.wait_for_many([text_hashes[i] for i in leased_elsewhere], namespace='summary')
+
+            for i, summary in zip(leased_elsewhere, awaited_summaries):
+                if handler.should_cancel:
+                    break
+
+                summarized_texts[i] = summary if summary is not None else self._summarize(full_texts[i], text_hashes[i], handler)
+                handler.increment_progress()
+
+        data.documents[self.target_column_name] = [summarized_texts[i] for i in inverse]
         data.set_text_column(self.target_column_name)
         data.history[str(len(data.history) + 1)] = data.documents.copy(deep=True)
 
         return data
 
 
+    def _summarize(self, text: str, text_hash: str, handler: PipelineStepHandler) -> str:
+        # Every summary is cached right away, so tasks waiting for the lease get it as soon as possible and paid LLM calls are kept even if a later one fails.
+        try:
+            summary = self.llm.generate(self.summarize_prompt + text, self.model_name)
+            handler.put_many({text_hash: summary}, namespace='summary')
+        finally:
+            handler.release_lease(text_hash)
+
+        return summary
+
+
     @staticmethod
     def get_info() -> dict:
         return {
@@ -124,3 +153,7 @@ class DocumentSummarizerStep(PipelineStep):
     @staticmethod
     def get_name() -> str:
         return "Document summarizer"
+
+
+    def get_cache_version(self) -> str:
+        return hashlib.sha1(self.summarize_prompt.encode()).hexdigest()[:8]
@@ -25,7 +25,7 @@ class EmbeddingRerankerStep(PipelineStep):
             self.query = None
             self.use_new_query = False
 
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()) -> PipelineIntermediate:
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler) -> PipelineIntermediate:
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step. The 'transform()' method executes the reranking logic by generating embeddings, computing cosine similarity, and updating the PipelineIntermediate with scores and ranks. 
             
@@ -31,7 +31,7 @@ class GeoDataFilteringStep(PipelineStep):
         self.longitude_column_name = longitude_column_name
 
 
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()):
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler):
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step. Apply geographic filtering to the pipeline's documents.
             
@@ -48,7 +48,7 @@ class GroupStyleLLMRerankerStep(PipelineStep):
             self.use_new_query = False
 
 
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()):
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler):
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step.  Apply the reranking step to the given pipeline data.
             
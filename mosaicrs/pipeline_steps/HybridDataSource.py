@@ -0,0 +1,305 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+import mosaicrs.pipeline.PipelineErrorHandling as err
+from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
+from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
+from mosaicrs.pipeline_steps.ChromaDataSource import ChromaDataSource
+from mosaicrs.pipeline_steps.MeiliDataSource import MeiliDataSource
+from mosaicrs.pipeline_steps.MosaicDataSource import MosaicDataSource
+from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
+from mosaicrs.pipeline_steps.utils import get_most_current_ranking
+
+
+_source_names = ['mosaic', 'chroma', 'meili']
+
+# Damping constant of the reciprocal rank fusion, as in the ChromaDataSource.
+_rrf_k = 60
+
+
+class HybridDataSource(PipelineStep):
+
+    def __init__(self, sources: str = 'mosaic,chroma', limit: str = '20', fusion: str = 'rrf', weights: str = '',
+                 search_index: str = 'simplewiki', output_column: str = 'full-text'):
+        """
+            Retrieves the initial result set from several data sources at once. The sources are queried concurrently, so the step takes as long as the slowest source instead of the sum of all of them. Documents found by several sources are kept once (identified by their URL, or their id if they have none) and the rankings of the sources are fused into the column '_original_ranking_'.
+
+            sources: str -> Comma separated data sources to query: 'mosaic' (MosaicDataSource), 'chroma' (ChromaDataSource) and 'meili' (MeiliDataSource), each with its default settings.\n
+            limit: str -> Number of documents retrieved from every source and number of fused documents that are kept.\n
+            fusion: str -> 'rrf' sums the reciprocal ranks of a document in all sources, 'weighted' sums its position in every source scaled to [0, 1] (1 for the top document), multiplied by the weight of the source.\n
+            weights: str -> Weights of the sources, e.g. 'chroma=2,meili=0.5'. Sources without a weight get 1. Applies to both fusion methods.\n
+            search_index: str -> MOSAIC index to search.\n
+            output_column: str -> Column that receives the text of the documents of all sources.
+        """
+
+        self.sources = [source.strip().lower() for source in sources.split(',') if source.strip()]
+        unknown_sources = [source for source in self.sources if source not in _source_names]
+        if len(unknown_sources) > 0 or len(self.sources) == 0:
+            raise ValueError(f"Invalid sources '{sources}'. Supported sources are: {', '.join(_source_names)}.")
+
+        if fusion not in ['rrf', 'weighted']:
+            raise ValueError(f"Invalid fusion '{fusion}'. Supported methods are: rrf, weighted.")
+
+        self.sources = list(dict.fromkeys(self.sources))
+        self.limit = limit.strip() if limit.strip().isdigit() else '20'
+        self.fusion = fusion
+        self.weights = self._parse_weights(weights)
+        self.search_index = search_index
+        self.output_column = output_column
+
+
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler) -> PipelineIntermediate:
+        handler.update_progress(0, 100)
+
+        # The sources share the cache and log of the handler, but each of them reports its own progress and works on its own intermediate.
+        source_handlers = {source: _SourceHandler(handler, lambda: self._aggregate_progress(handler, source_handlers)) for source in self.sources}
+
+        with ThreadPoolExecutor(max_workers=len(self.sources)) as executor:
+            futures = {source: executor.submit(self._retrieve, source, data.query, source_handlers[source]) for source in self.sources}
+
+        results = {}
+        for source, future in futures.items():
+            try:
+                results[source] = future.result()
+            except Exception as e:
+                if len(self.sources) == 1:
+                    raise
+                handler.warning(err.PipelineStepWarning(err.WarningMessages.DataSourceFailed, source=source, exception_name=type(e).__name__, exception=str(e)))
+
+        if len(results) == 0:
+            raise futures[self.sources[0]].exception()
+
+        handler.log('Retrieved ' + ', '.join('{} documents from {}'.format(len(documents), source) for source, documents in results.items()))
+
+        df_docs = self._fuse([documents for documents in results.values() if not documents.empty])
+        handler.log('Fused {} documents'.format(len(df_docs)))
+
+        if data.documents.empty:
+            data.documents = df_docs
+        else:
+            if not df_docs.empty:
+                df_docs['_original_ranking_'] += max(get_most_current_ranking(data))
+            data.documents = pd.concat([data.documents, df_docs], ignore_index=True)
+
+        data.set_text_column(self.output_column)
+        data.set_rank_column('_original_ranking_')
+        data.set_chip_column('_sources_')
+
+        handler.update_progress(100, 100)
+
+        data.history[str(len(data.history)+1)] = data.documents.copy(deep=True)
+
+        return data
+
+    def _retrieve(self, source: str, query: str, handler: PipelineStepHandler) -> pd.DataFrame:
+        """
+            Runs the data source on a fresh intermediate and returns its documents in the order of its ranking, with the text in the output column and the columns '_source_' and '_source_rank_'.
+        """
+
+        match source:
+            case 'mosaic':
+                step = MosaicDataSource(output_column=self.output_column, search_index=self.search_index, limit=self.limit)
+            case 'chroma':
+                step = ChromaDataSource(output_column=self.output_column, limit=self.limit)
+            case 'meili':
+                step = MeiliDataSource(output_column=self.output_column, limit=self.limit)
+
+        try:
+            source_data = step.transform(PipelineIntermediate(query, {}), handler)
+        finally:
+            handler.update_progress(1, 1)
+
+        documents = source_data.documents.reset_index(drop=True)
+        if documents.empty:
+            return documents
+
+        metadata = source_data.metadata
+        rank_columns = [column for column in metadata[metadata['rank'] == True]['id'] if column in documents]
+        if len(rank_columns) > 0:
+            documents = documents.sort_values(rank_columns[-1], kind='stable').reset_index(drop=True)
+
+        text_columns = [column for column in metadata[metadata['text'] == True]['id'] if column in documents]
+        if len(text_columns) > 0 and text_columns[-1] != self.output_column:
+            documents[self.output_column] = documents[text_columns[-1]]
+
+        documents = documents.drop(columns=['_original_ranking_'], errors='ignore')
+        documents['_source_'] = source
+        documents['_source_rank_'] = np.arange(1, len(documents) + 1)
+
+        return documents
+
+    @staticmethod
+    def _aggregate_progress(handler: PipelineStepHandler, source_handlers: dict):
+        # Percentage of the average progress of the sources, sources that did not report a total yet count as 0.
+        fractions = [min(1.0, current / total) if total > 0 else 0.0 for current, total in (source_handler.progress for source_handler in source_handlers.values())]
+        handler.update_progress(int(100 * sum(fractions) / len(fractions)), 100)
+
+    def _fuse(self, results: List[pd.DataFrame]) -> pd.DataFrame:
+        """
+            Deduplicates the documents of all sources and orders them by their fused score. The content of a document is taken from the source that contributes most to its score, its rank in every source is kept in the column '{source}_rank'.
+        """
+
+        if len(results) == 0:
+            return pd.DataFrame()
+
+        hits = pd.concat(results, ignore_index=True)
+        hits['_key_'] = self._document_keys(hits)
+
+        # A source may return the same page several times, e.g. from several MOSAIC indexes. Only its best rank counts.
+        hits = hits.drop_duplicates(['_source_', '_key_']).reset_index(drop=True)
+
+        weights = hits['_source_'].map(lambda source: self.weights.get(source, 1.0))
+        if self.fusion == 'weighted':
+            source_sizes = hits.groupby('_source_')['_source_rank_'].transform('max')
+            hits['_contribution_'] = weights * (1.0 - (hits['_source_rank_'] - 1) / source_sizes)
+        else:
+            hits['_contribution_'] = weights / (_rrf_k + hits['_source_rank_'])
+
+        fused = hits.groupby('_key_').agg(
+            _fused_score_=('_contribution_', 'sum'),
+            _best_rank_=('_source_rank_', 'min'),
+            _sources_=('_source_', lambda sources: ', '.join(sorted(sources))),
+        )
+
+        source_ranks = hits.pivot(index='_key_', columns='_source_', values='_source_rank_')
+        source_ranks.columns = ['{}_rank'.format(source) for source in source_ranks.columns]
+
+        best_hits = hits.sort_values('_contribution_', ascending=False, kind='stable').drop_duplicates('_key_').set_index('_key_')
+        best_hits = best_hits.drop(columns=['_contribution_', '_source_rank_'])
+
+        documents = best_hits.join(fused).join(source_ranks)
+        documents = documents.sort_values(['_fused_score_', '_best_rank_'], ascending=[False, True], kind='stable').head(int(self.limit))
+        documents = documents.drop(columns=['_best_rank_']).reset_index(drop=True)
+
+        documents['_original_ranking_'] = documents.index + 1
+
+        return documents
+
+    @staticmethod
+    def _document_keys(hits: pd.DataFrame) -> pd.Series:
+        # The same page may be reported with another scheme, a 'www.' prefix or a trailing slash by the different sources.
+        keys = pd.Series(None, index=hits.index, dtype=object)
+
+        if 'url' in hits:
+            urls = hits['url'].where(hits['url'].map(lambda url: isinstance(url, str) and url.strip() != ''))
+            keys = urls.str.strip().str.lower().str.replace(r'^[a-z][a-z0-9+.-]*://(www\.)?', '', regex=True).str.rstrip('/')
+
+        if 'id' in hits:
+            keys = keys.fillna(hits['id'].map(lambda doc_id: 'id:{}'.format(doc_id) if pd.notna(doc_id) else None))
+
+        # Documents without URL and id are never merged.
+        return keys.fillna(hits['_source_'] + ':' + hits['_source_rank_'].astype(str))
+
+    @staticmethod
+    def _parse_weights(weights: str) -> Dict[str, float]:
+        parsed = {}
+        for entry in weights.split(','):
+            if not entry.strip():
+                continue
+
+            source, _, weight = entry.partition('=')
+            try:
+                parsed[source.strip().lower()] = float(weight)
+            except ValueError:
+                raise ValueError(f"Invalid weight '{entry.strip()}'. Weights have the form 'source=number', e.g. 'chroma=2,meili=0.5'.")
+
+        return parsed
+
+    def get_cache_version(self) -> str:
+        # Only the MosaicDataSource caches results that depend on its settings (the truncated full texts).
+        return MosaicDataSource().get_cache_version() if 'mosaic' in self.sources else ''
+
+    @staticmethod
+    def get_info() -> dict:
+        return {
+            "name": HybridDataSource.get_name(),
+            "category": "Data Sources",
+            "description": "Retrieve the initial result set from several data sources at once and fuse their rankings.",
+            "parameters": {
+                'sources': {
+                    'title': 'Sources',
+                    'description': 'Comma separated data sources that are queried concurrently: mosaic, chroma and meili.',
+                    'type': 'dropdown',
+                    'enforce-limit': False,
+                    'required': True,
+                    'supported-values': ['mosaic,chroma', 'mosaic,meili', 'chroma,meili', 'mosaic,chroma,meili'],
+                    'default': 'mosaic,chroma',
+                },
+                'limit': {
+                    'title': 'Limit',
+                    'description': 'Number of results retrieved from every source and number of fused results that are kept.',
+                    'type': 'dropdown',
+                    'enforce-limit': False,
+                    'required': True,
+                    'supported-values': ['5', '10', '20', '50', '100', '200'],
+                    'default': '20',
+                },
+                'fusion': {
+                    'title': 'Rank fusion',
+                    'description': '"rrf" (reciprocal rank fusion) rewards documents found by several sources, "weighted" sums the weighted positions of a document in the sources scaled to [0, 1].',
+                    'type': 'dropdown',
+                    'enforce-limit': True,
+                    'required': True,
+                    'supported-values': ['rrf', 'weighted'],
+                    'default': 'rrf',
+                },
+                'weights': {
+                    'title': 'Source weights',
+                    'description': 'Weights of the sources in the fusion, e.g. "chroma=2,meili=0.5". Sources without a weight get 1. Optional.',
+                    'type': 'string',
+                    'required': False,
+                    'default': '',
+                },
+                'search_index': {
+                    'title': 'MOSAIC index',
+                    'description': 'Index searched by the MOSAIC source.',
+                    'type': 'dropdown',
+                    'enforce-limit': False,
+                    'required': True,
+                    'supported-values': list(set(MosaicDataSource.get_index_names() + ['arts', 'health', 'recreation', 'science', 'all'])),
+                    'default': 'simplewiki',
+                },
+                'output_column': {
+                    'title': 'Output Column',
+                    'description': 'Output column of the document texts of all sources.',
+                    'type': 'dropdown',
+                    'enforce-limit': False,
+                    'required': True,
+                    'supported-values': ['full-text'],
+                    'default': 'full-text',
+                },
+            }
+        }
+
+    @staticmethod
+    def get_name() -> str:
+        return "Hybrid Data Source"
+
+
+class _SourceHandler:
+    """
+        Handler passed to one source of the HybridDataSource. Progress updates are recorded per source and reported to the step handler as the progress of all sources, everything else (cache, log, cancellation) is delegated to the step handler.
+    """
+
+    def __init__(self, handler: PipelineStepHandler, on_progress):
+        self.progress = (0, 0)
+        self.progress_lock = Lock()
+        self._handler = handler
+        self._on_progress = on_progress
+
+    def __getattr__(self, name):
+        return getattr(self._handler, name)
+
+    def update_progress(self, current_iteration, total_iterations):
+        with self.progress_lock:
+            self.progress = (current_iteration, total_iterations)
+        self._on_progress()
+
+    def increment_progress(self):
+        with self.progress_lock:
+            self.progress = (self.progress[0] + 1, self.progress[1])
+        self._on_progress()
@@ -1,24 +1,53 @@
-import meilisearch
+import os
+import asyncio
+from typing import List, Optional
+
+import aiohttp
 import pandas as pd
 
+from mosaicrs.pipeline.HttpClient import run_async, post_json
 from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
 from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
+from mosaicrs.pipeline_steps.CurlieFilterStep import CurlieFilterStep
 from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
+from mosaicrs.pipeline_steps.utils import truncate_text, truncated_column
+
+
+_meili_url = os.environ.get('MEILI_URL', 'http://dallions:7700')
+_meili_api_key = os.environ.get('MEILI_API_KEY', 'k5brEECPmrM5bhQpDDzvJz3v')
+_meili_index = os.environ.get('MEILI_INDEX', 'curlie_en')
+
+# Large limits are retrieved as concurrent pages of this size.
+_page_size = int(os.environ.get('MEILI_PAGE_SIZE', '100'))
+
+_curlie_column = 'curlielabels_en'
 
 
 class MeiliDataSource(PipelineStep):
 
-    def __init__(self, output_column: str = 'full-text', limit='100'):
+    def __init__(self, output_column: str = 'full-text', limit='100', attributes: str = 'title,url,curlielabels_en', filter_by: str = '', filter_mode: str = 'OR'):
+        """
+            Retrieves documents from a Meilisearch index through its REST API. Only the text and the given attributes are transferred, large limits are retrieved as concurrent pages and Curlie label filters are evaluated by Meilisearch.
+
+            output_column: str -> Column that receives the plain text of the documents.\n
+            limit: str -> Number of documents to retrieve.\n
+            attributes: str -> Comma separated list of further attributes to retrieve, e.g. 'title,url,curlielabels_en,warc_file'.\n
+            filter_by: str -> Comma separated Curlie labels (of curlielabels_en) to filter by, see the CurlieFilterStep. Empty disables the filter.\n
+            filter_mode: str -> 'OR' keeps documents with any of the labels, 'AND' with all of them, 'NOT' with none of them.
+        """
+
         self.target_column_name = output_column
         self.limit = limit
-        self.client = meilisearch.Client('http://dallions:7700', 'k5brEECPmrM5bhQpDDzvJz3v')
         self.output_column = output_column
+        self.attributes = [attribute.strip() for attribute in attributes.split(',') if attribute.strip() and attribute.strip() != 'plain_text']
+        self.filter_by = filter_by
+        self.filter_mode = filter_mode
 
 
     def transform(self, data: PipelineIntermediate,
-                  handler: PipelineStepHandler = PipelineStepHandler()) -> PipelineIntermediate:
+                  handler: PipelineStepHandler) -> PipelineIntermediate:
 
-        data.documents = self.query_meilisearch_to_dataframe(data.query)
+        data.documents = self.query_meilisearch_to_dataframe(data.query, handler)
 
         data.set_text_column(self.output_column)
 
@@ -49,6 +78,31 @@ class MeiliDataSource(PipelineStep):
                     'supported-values': ['plain_text', 'full-text'],
                     'default': 'full-text',
                 },
+                'attributes': {
+                    'title': 'Attributes',
+                    'description': 'Comma separated document attributes to retrieve besides the text. Attributes that no later step uses only add transfer time.',
+                    'type': 'dropdown',
+                    'enforce-limit': False,
+                    'required': False,
+                    'supported-values': ['title,url,curlielabels_en', 'title,url,curlielabels,curlielabels_en,ows_tags,warc_file'],
+                    'default': 'title,url,curlielabels_en',
+                },
+                'filter_by': {
+                    'title': 'Curlie labels',
+                    'description': 'Only retrieve documents with these Curlie labels (comma separated). The filter is evaluated by Meilisearch. Optional.',
+                    'type': 'string',
+                    'required': False,
+                    'default': '',
+                },
+                'filter_mode': {
+                    'title': 'Filter mode',
+                    'description': 'OR keeps documents with any of the labels, AND with all of them, NOT with none of them.',
+                    'type': 'dropdown',
+                    'enforce-limit': True,
+                    'required': True,
+                    'supported-values': ['OR', 'AND', 'NOT'],
+                    'default': 'OR',
+                },
             }
         }
 
@@ -58,35 +112,97 @@ class MeiliDataSource(PipelineStep):
 
 
 
-    def query_meilisearch_to_dataframe(self, query: str) -> pd.DataFrame:
-            index = self.client.index('curlie_en')
+    def query_meilisearch_to_dataframe(self, query: str, handler: Optional[PipelineStepHandler] = None) -> pd.DataFrame:
+            hits, filtered = run_async(self._search(query, handler))
+
+            data_for_df = []
+            for hit in hits:
+                text, truncated = truncate_text(hit.get('plain_text'))
+                data_for_df.append({
+                    **{attribute: hit.get(attribute) for attribute in self.attributes},
+                    self.output_column: text,
+                    truncated_column: truncated,
+                })
 
-            search_params = {
-                'attributesToRetrieve': ['title', 'plain_text', 'url', 'curlielabels', 'curlielabels_en', 'ows_tags', 'warc_file'],
-                'attributesToSearchOn': ['plain_text'],
-                'limit': int(self.limit)
-            }
-            search_result = index.search(query, search_params)
-
-            hits = search_result.get('hits', []) # Use .get for safety
-
-            # 5. Prepare data for DataFrame
-            # Using .get() for each key ensures that if a field is missing in a
-            # specific document, it gets a None value instead of raising an error.
-            data_for_df = [
-                {
-                    'title': hit.get('title'),
-                    self.output_column: hit.get('plain_text'),
-                    'url': hit.get('url'),
-                    'curlielabels': hit.get('curlielabels'),
-                    'curlielabels_en': hit.get('curlielabels_en'),
-                    'ows_tags': hit.get('ows_tags'),
-                    'warc_file': hit.get('warc_file'),
-                }
-                for hit in hits
-            ]
-
-            # 6. Create Pandas DataFrame
             df = pd.DataFrame(data_for_df)
 
-            return df
\ No newline at end of file
+            if not filtered and self.filter_by.strip() and not df.empty:
+                # The index does not allow filtering on the labels, so the filter is applied to the retrieved documents.
+                if _curlie_column not in df:
+                    df[_curlie_column] = [hit.get(_curlie_column) for hit in hits]
+
+                filter_step = CurlieFilterStep(curlie_column=_curlie_column, filter_by=self.filter_by, filter_mode=self.filter_mode)
+                intermediate = PipelineIntermediate(query, {})
+                intermediate.documents = df
+                df = filter_step.transform(intermediate, handler).documents
+
+            return df
+
+    async def _search(self, query: str, handler: Optional[PipelineStepHandler]):
+        """
+            Returns the hits and whether the label filter was applied by Meilisearch. The first page reports the estimated number of hits, the remaining pages are requested concurrently.
+        """
+
+        limit = int(self.limit)
+        filter_expression = self._filter_expression()
+
+        try:
+            pages = await self._request_pages(query, limit, filter_expression)
+            filtered = True
+        except aiohttp.ClientResponseError as e:
+            if filter_expression is None or e.status != 400:
+                raise
+
+            # Most likely the labels are not a filterable attribute of the index.
+            if handler is not None:
+                handler.log('Meilisearch rejected the label filter, filtering after retrieval: {}'.format(e.message))
+            pages = await self._request_pages(query, limit, None, retrieve_labels=True)
+            filtered = False
+
+        return [hit for page in pages for hit in page], filtered
+
+    async def _request_pages(self, query: str, limit: int, filter_expression: Optional[str], retrieve_labels: bool = False) -> List[list]:
+        attributes = ['plain_text'] + self.attributes + ([_curlie_column] if retrieve_labels and _curlie_column not in self.attributes else [])
+
+        page_size = min(limit, _page_size) if _page_size > 0 else limit
+        first_page = await self._request_page(query, 0, page_size, attributes, filter_expression)
+
+        total = min(limit, first_page.get('estimatedTotalHits', limit))
+        if len(first_page.get('hits', [])) < page_size or total <= page_size:
+            return [first_page.get('hits', [])]
+
+        remaining = await asyncio.gather(*[self._request_page(query, offset, min(page_size, total - offset), attributes, filter_expression)
+                                           for offset in range(page_size, total, page_size)])
+
+        return [first_page.get('hits', [])] + [page.get('hits', []) for page in remaining]
+
+    async def _request_page(self, query: str, offset: int, limit: int, attributes: List[str], filter_expression: Optional[str]) -> dict:
+        payload = {
+            'q': query,
+            'attributesToRetrieve': attributes,
+            'attributesToSearchOn': ['plain_text'],
+            'offset': offset,
+            'limit': limit,
+        }
+        if filter_expression is not None:
+            payload['filter'] = filter_expression
+
+        return await post_json('{}/indexes/{}/search'.format(_meili_url.rstrip('/'), _meili_index), payload,
+                               headers={'Authorization': 'Bearer {}'.format(_meili_api_key)})
+
+    def _filter_expression(self) -> Optional[str]:
+        labels = [label.strip() for label in self.filter_by.split(',') if label.strip()]
+        if len(labels) == 0:
+            return None
+
+        values = ['"{}"'.format(label.replace('\\', '\\\\').replace('"', '\\"')) for label in labels]
+
+        match self.filter_mode:
+            case 'OR':
+                return '{} IN [{}]'.format(_curlie_column, ', '.join(values))
+            case 'AND':
+                return ' AND '.join('{} = {}'.format(_curlie_column, value) for value in values)
+            case 'NOT':
+                return '{} NOT IN [{}]'.format(_curlie_column, ', '.join(values))
+
+        raise ValueError(f"Invalid filter_mode '{self.filter_mode}'. Supported modes are: OR, AND, NOT.")
@@ -1,16 +1,41 @@
+import os
+import time
+import hashlib
+import threading
 import requests
 import json
 import pandas as pd
+from typing import List, Optional, Tuple
 import regex as re
 from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
 from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
+from mosaicrs.pipeline.HttpClient import get_http_session, http_timeout, run_async, fetch_text, fetch_text_with_status, fetch_text_prefix
 from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
 import logging
 
 import asyncio
-import aiohttp
-import ssl
-from mosaicrs.pipeline_steps.utils import get_most_current_ranking
+from mosaicrs.pipeline_steps.utils import get_most_current_ranking, truncate_text, truncated_column, ingest_max_chars, ingest_truncation
+
+
+# Search results change when the MOSAIC indexes are updated, so they are cached much shorter than full texts.
+_search_cache_ttl = int(os.environ.get('MOSAIC_SEARCH_CACHE_TTL', '600'))
+
+# Limits above the page size are retrieved as concurrent pages of this size (using the offset parameter of the search API).
+_search_page_size = int(os.environ.get('MOSAIC_SEARCH_PAGE_SIZE', '50'))
+_search_pages_in_flight = max(1, int(os.environ.get('MOSAIC_SEARCH_PAGES_IN_FLIGHT', '4')))
+
+# Instances that were found to ignore the offset parameter are searched with a single request.
+_offset_unsupported_urls = set()
+
+# The index names of the step catalog are refreshed in the background, the last successfully fetched names are served in the meantime.
+_index_info_url = "https://mosaic.ows.eu/service/api/index-info"
+_index_info_ttl = float(os.environ.get('MOSAIC_INDEX_INFO_TTL', '3600'))
+_index_info_retry_seconds = 60.0
+
+_index_names_lock = threading.Lock()
+_index_names = None
+_index_names_next_refresh = 0.0
+_index_names_refreshing = False
 
 
 class MosaicDataSource(PipelineStep):
@@ -24,10 +49,8 @@ class MosaicDataSource(PipelineStep):
         self.index = search_index
         self.limit = limit.strip() if limit.strip().isdigit() else "10"
 
-        self.request_limiter_semaphore = asyncio.Semaphore(50)
 
-
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()) -> PipelineIntermediate:
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler) -> PipelineIntermediate:
         data.arguments.clear()
 
         if self.consider_query:
@@ -54,38 +77,19 @@ class MosaicDataSource(PipelineStep):
 
         data.arguments['limit'] = int(self.limit)
 
-        response = requests.get(''.join([self.mosaic_url, self.search_path_part]), params=data.arguments)
-
-        if response.status_code == 404:
-            handler.log('Data Source service not found (404)')
-            raise ValueError("Error: Source not found")
-
-        json_data = json.loads(response.text)
+        if self._use_paging(data.arguments['limit']):
+            df_docs = self._paged_search(handler, data.arguments)
+        else:
+            df_docs = self._single_search(handler, data.arguments)
 
-        if "results" not in json_data:
+        if df_docs is None:
             handler.log('no \'results\' in json data')
             return data
 
-        extracted_docs = []
-        for index_result in json_data["results"]:
-            for key, v in index_result.items():
-                for doc in v:
-                    doc["_source_index_"] = key
-                    extracted_docs.append(doc)
-        
-        df_docs = pd.DataFrame(extracted_docs)
-        df_docs["_original_ranking_"] = df_docs.index + 1
+        if df_docs[truncated_column].any():
+            handler.log('Truncated {} of {} documents to at most {} characters'.format(df_docs[truncated_column].sum(), len(df_docs), ingest_max_chars))
 
-        df_docs[self.target_column_name] = None
-
-        handler.update_progress(0, len(df_docs))
-
-
-
-        if 'mainContent' in df_docs and (df_docs['mainContent'].str.len() > 0).any():
-            df_docs[self.target_column_name] = df_docs['mainContent']
-        else:
-            df_docs = asyncio.run(self._fetch_all_texts(handler, df_docs))
+        df_docs["_original_ranking_"] = df_docs.index + 1
 
         if data.documents.empty:
             data.documents = df_docs
@@ -110,13 +114,221 @@ class MosaicDataSource(PipelineStep):
 
         return data
 
+    def _search(self, handler: PipelineStepHandler, arguments: dict) -> dict:
+        cached = self._get_cached_search(handler, arguments)
+        if cached is not None:
+            handler.log('Reusing cached search results')
+            return cached
+
+        response = get_http_session().get(''.join([self.mosaic_url, self.search_path_part]), params=arguments, timeout=http_timeout)
+
+        if response.status_code == 404:
+            handler.log('Data Source service not found (404)')
+            raise ValueError("Error: Source not found")
+
+        json_data = json.loads(response.text)
+
+        if response.status_code == 200:
+            self._put_cached_search(handler, arguments, json_data)
+
+        return json_data
+
+    def _get_cached_search(self, handler: PipelineStepHandler, arguments: dict) -> Optional[dict]:
+        if _search_cache_ttl <= 0:
+            return None
+
+        limit = arguments['limit']
+        cached = handler.get_cache(self._search_cache_key(arguments), namespace='search')
+        if cached is None:
+            return None
+
+        entry = json.loads(cached)
+        if time.time() - entry['fetched_at'] >= _search_cache_ttl or not self._can_serve(entry, limit):
+            return None
+
+        return self._limit_results(entry['response'], limit)
+
+    def _put_cached_search(self, handler: PipelineStepHandler, arguments: dict, json_data: dict):
+        if "results" in json_data and _search_cache_ttl > 0:
+            entry = {'fetched_at': time.time(), 'limit': arguments['limit'], 'response': json_data}
+            handler.put_many({self._search_cache_key(arguments): json.dumps(entry)}, namespace='search', ttl=_search_cache_ttl)
+
+    def _search_cache_key(self, arguments: dict) -> str:
+        # The limit is not part of the key, so one entry can serve all smaller limits.
+        normalized = {key: value for key, value in arguments.items() if key != 'limit' and not (key == 'offset' and value == 0)}
+        if 'q' in normalized:
+            normalized['q'] = ' '.join(str(normalized['q']).split()).lower()
+        normalized['_url_'] = ''.join([self.mosaic_url, self.search_path_part])
+
+        return 'search-{}'.format(hashlib.sha1(json.dumps(normalized, sort_keys=True, default=str).encode()).hexdigest())
+
+    @staticmethod
+    def _can_serve(entry: dict, limit: int) -> bool:
+        if entry['limit'] == limit:
+            return True
+
+        # With several indexes it is unknown how MOSAIC distributes the limit among them, so only single-index responses are cut down.
+        results = entry['response'].get('results', [])
+        if len(results) != 1:
+            return False
+
+        docs = next(iter(results[0].values()), [])
+        # A response with fewer documents than its limit is complete and serves any limit.
+        return entry['limit'] > limit or len(docs) < entry['limit']
+
+    @staticmethod
+    def _limit_results(json_data: dict, limit: int) -> dict:
+        return {**json_data, 'results': [{key: docs[:limit] for key, docs in index_result.items()} for index_result in json_data['results']]}
+
+    @staticmethod
+    def _extract_docs(json_data: dict) -> list:
+        extracted_docs = []
+        for index_result in json_data["results"]:
+            for key, v in index_result.items():
+                for doc in v:
+                    doc["_source_index_"] = key
+                    extracted_docs.append(doc)
+
+        return extracted_docs
+
+    def _use_paging(self, limit: int) -> bool:
+        # How MOSAIC splits the limit among several indexes is unknown, so only single-index searches are paged.
+        return limit > _search_page_size > 0 and self.index != "all" and self.mosaic_url not in _offset_unsupported_urls
+
+    def _single_search(self, handler: PipelineStepHandler, arguments: dict) -> Optional[pd.DataFrame]:
+        json_data = self._search(handler, arguments)
+
+        if "results" not in json_data:
+            return None
+
+        df_docs = pd.DataFrame(self._extract_docs(json_data))
+        df_docs[self.target_column_name] = None
+
+        handler.update_progress(0, len(df_docs))
+
+        return self._fetch_all_texts(handler, df_docs)
+
+    def _paged_search(self, handler: PipelineStepHandler, arguments: dict) -> Optional[pd.DataFrame]:
+        """
+            Retrieves the search results as concurrent pages of MOSAIC_SEARCH_PAGE_SIZE documents. The full texts of a page are requested as soon as the page arrives, while later pages are still in flight. Up to MOSAIC_SEARCH_PAGES_IN_FLIGHT pages are requested at once. Once a page comes back short the index is exhausted, the requests for the following pages are cancelled and no further pages are requested. If a page only repeats documents of the previous pages, the instance ignores the offset parameter: the results are then requested with a single request, and the instance is never paged again. Returns None if MOSAIC did not return any results.
+        """
+
+        handler.update_progress(0, arguments['limit'])
+
+        docs, texts, offset_ignored = run_async(self._request_pages(handler, arguments))
+        if offset_ignored:
+            handler.log('MOSAIC ignored the offset parameter, requesting all results at once')
+            _offset_unsupported_urls.add(self.mosaic_url)
+            # The full texts of the first page are cached by now.
+            return self._single_search(handler, arguments)
+
+        if docs is None:
+            return None
+
+        df_docs = pd.DataFrame(docs)
+        df_docs[self.target_column_name] = [text for text, _ in texts]
+        df_docs[truncated_column] = [truncated for _, truncated in texts]
+
+        handler.update_progress(len(df_docs), len(df_docs))
+        return df_docs
+
+    async def _request_pages(self, handler: PipelineStepHandler, arguments: dict):
+        limit = arguments['limit']
+        page_arguments = [{**arguments, 'offset': offset, 'limit': min(_search_page_size, limit - offset)} for offset in range(0, limit, _search_page_size)]
+        pages = []
+
+        docs = []
+        seen_ids = set()
+        text_tasks = []
+        received_results = False
+        offset_ignored = False
+
+        try:
+            for page_number, page_argument in enumerate(page_arguments):
+                # Keep a window of pages in flight, pages far beyond the end of the results are never requested.
+                while len(pages) < min(page_number + _search_pages_in_flight, len(page_arguments)):
+                    pages.append(asyncio.create_task(self._request_page(handler, page_arguments[len(pages)])))
+
+                json_data = await pages[page_number]
+                if "results" not in json_data:
+                    break
+
+                received_results = True
+                page_docs = self._extract_docs(json_data)
+
+                # Results may shift between pages if the index changes while paging.
+                new_docs = [doc for doc in page_docs if doc.get('id') is None or doc.get('id') not in seen_ids]
+                seen_ids.update(doc.get('id') for doc in new_docs)
+
+                # A full page without a single new document means the offset was not applied.
+                if page_number > 0 and len(page_docs) > 0 and len(new_docs) == 0:
+                    offset_ignored = True
+                    break
+
+                docs.extend(new_docs)
+                text_tasks.append(asyncio.create_task(self._request_texts(handler, new_docs)))
+                handler.log('Received search page {} with {} documents'.format(page_number + 1, len(page_docs)))
+
+                if len(page_docs) < page_argument['limit'] or handler.should_cancel:
+                    break
+        except BaseException:
+            for task in text_tasks:
+                task.cancel()
+            raise
+        finally:
+            for page in pages:
+                page.cancel()
+
+        texts = [text for page_texts in await asyncio.gather(*text_tasks) for text in page_texts]
+        return (docs, texts, offset_ignored) if received_results else (None, None, offset_ignored)
+
+    async def _request_page(self, handler: PipelineStepHandler, arguments: dict) -> dict:
+        cached = await asyncio.to_thread(self._get_cached_search, handler, arguments)
+        if cached is not None:
+            return cached
+
+        status, text = await fetch_text_with_status(''.join([self.mosaic_url, self.search_path_part]), params=arguments)
+
+        if status == 404:
+            handler.log('Data Source service not found (404)')
+            raise ValueError("Error: Source not found")
+
+        json_data = json.loads(text)
+
+        if status == 200:
+            await asyncio.to_thread(self._put_cached_search, handler, arguments, json_data)
+
+        return json_data
+
     @staticmethod
     def get_index_names():
-        url = "https://mosaic.ows.eu/service/api/index-info"
+        """
+            Returns the index names of the public MOSAIC instance. Only the very first call of a process waits for the request, afterwards the names are refreshed in a background thread every MOSAIC_INDEX_INFO_TTL seconds and the last known good names are returned immediately, even while MOSAIC is slow or down.
+        """
+
+        global _index_names_refreshing
+
+        with _index_names_lock:
+            index_names = _index_names
+            refresh = time.monotonic() >= _index_names_next_refresh and not _index_names_refreshing
+            if refresh:
+                _index_names_refreshing = True
+
+        if refresh and index_names is None:
+            return MosaicDataSource._refresh_index_names()
+
+        if refresh:
+            threading.Thread(target=MosaicDataSource._refresh_index_names, name='mosaic-index-info', daemon=True).start()
+
+        return list(index_names or [])
+
+    @staticmethod
+    def _refresh_index_names():
+        global _index_names, _index_names_next_refresh, _index_names_refreshing
 
         try:
             # Make the GET request
-            response = requests.get(url)
+            response = get_http_session().get(_index_info_url, timeout=http_timeout)
             # Raise an exception for HTTP errors (4xx or 5xx)
             response.raise_for_status()
 
@@ -126,11 +338,22 @@ class MosaicDataSource(PipelineStep):
             # result.keys() returns a view, so we convert to list or take the next iterator
             index_names = [list(item.keys())[0] for item in data.get("results", [])]
 
-            return index_names
+            with _index_names_lock:
+                _index_names = index_names
+                _index_names_next_refresh = time.monotonic() + _index_info_ttl
 
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, ValueError) as e:
             print(f"An error occurred: {e}")
-            return []
+
+            with _index_names_lock:
+                _index_names_next_refresh = time.monotonic() + _index_info_retry_seconds
+
+        finally:
+            with _index_names_lock:
+                _index_names_refreshing = False
+                index_names = _index_names
+
+        return list(index_names or [])
 
     @staticmethod
     def get_info() -> dict:
@@ -184,8 +407,12 @@ class MosaicDataSource(PipelineStep):
     def get_name() -> str:
         return "MosaicDataSource"
 
+    def get_cache_version(self) -> str:
+        # Cached full texts are already truncated.
+        return 'text-{}-{}'.format(ingest_max_chars, ingest_truncation)
+
     def _request_full_text(self, doc_id: str, handler: PipelineStepHandler) -> str:
-        response = requests.get(''.join([self.mosaic_url, self.full_text_path_part]), params={'id': doc_id})
+        response = get_http_session().get(''.join([self.mosaic_url, self.full_text_path_part]), params={'id': doc_id}, timeout=http_timeout)
         handler.increment_progress()
         if response.status_code == 200:
             json_data = json.loads(response.text)
@@ -193,41 +420,97 @@ class MosaicDataSource(PipelineStep):
         else:
             return ""
 
-    async def _request_full_text_async(self, session, doc_id: str, handler: PipelineStepHandler) -> str:
+    async def _request_full_text_async(self, doc_id: str, handler: PipelineStepHandler, fetched_texts: dict) -> Tuple[str, bool]:
         url = ''.join([self.mosaic_url, self.full_text_path_part])
         cache_key = 'full-text-for-id-{}'.format(doc_id)
 
-        result = handler.get_cache(cache_key)
-        if result is not None:
-            handler.increment_progress()
-            return result
+        # Connection reuse, TLS settings, concurrency limits, timeouts and retries are handled by the shared HTTP client.
+        # Bodies are read up to a byte budget that fits INGEST_MAX_CHARS characters even if all of them are JSON escaped.
+        if ingest_max_chars > 0:
+            result, complete = await fetch_text_prefix(url, ingest_max_chars * 6 + 64 * 1024, params={'id': doc_id})
+        else:
+            result, complete = await fetch_text(url, params={'id': doc_id}), True
+        handler.increment_progress()
 
+        if complete:
+            json_data = json.loads(result)
+            if 'fullText' not in json_data:
+                return result, False
+            text, truncated = truncate_text(json_data['fullText'])
+        else:
+            # Only the beginning of the page was read, so the tail is not available.
+            text, _ = truncate_text(self._read_partial_full_text(result), strategy='paragraph' if ingest_truncation == 'paragraph' else 'head')
+            truncated = True
 
-        ssl_context = ssl.create_default_context()
-        ssl_context.check_hostname = False
-        ssl_context.verify_mode = ssl.CERT_NONE  # Disables SSL verification
+        fetched_texts[cache_key] = json.dumps({'text': text, 'truncated': truncated})
+        return text, truncated
 
-        async with self.request_limiter_semaphore:
-            async with session.get(url, ssl=ssl_context, params={'id': doc_id}) as response:
-                result = await response.text()
-                handler.increment_progress()
+    @staticmethod
+    def _read_partial_full_text(body: str) -> str:
+        match = re.search(r'"fullText"\s*:\s*"', body)
+        if match is None:
+            return ''
 
-                json_data = json.loads(result)
-                if 'fullText' in json_data:
-                    handler.put_cache(cache_key, json_data['fullText'])
-                    return json_data['fullText']
+        try:
+            return json.decoder.scanstring(body, match.end())[0]
+        except ValueError:
+            pass
 
-                return result
+        # The string was cut, drop a trailing incomplete escape sequence before decoding it.
+        raw = re.sub(r'\\u[0-9a-fA-F]{0,3}$', '', body[match.end():])
+        if (len(raw) - len(raw.rstrip('\\'))) % 2 == 1:
+            raw = raw[:-1]
 
+        try:
+            text = json.loads('"' + raw + '"')
+        except ValueError:
+            return ''
 
-    async def _fetch_all_texts(self, handler: PipelineStepHandler, df_docs):
-        async with aiohttp.ClientSession() as session:
-            tasks = [self._request_full_text_async(session, row['id'], handler) for _, row in df_docs.iterrows()]
-            results = await asyncio.gather(*tasks)
+        # A surrogate pair may have been cut in half.
+        return text[:-1] if text and '\ud800' <= text[-1] <= '\udbff' else text
 
 
-        df_docs[self.target_column_name] = results
+    def _fetch_all_texts(self, handler: PipelineStepHandler, df_docs):
+        texts = run_async(self._request_texts(handler, df_docs.to_dict('records')))
+        df_docs[self.target_column_name] = [text for text, _ in texts]
+        df_docs[truncated_column] = [truncated for _, truncated in texts]
         return df_docs
+
+    async def _request_texts(self, handler: PipelineStepHandler, docs: list) -> List[Tuple[str, bool]]:
+        """
+            Returns (text, truncated) for every document. Texts are bounded by `truncate_text` before they are cached, the cache stores both values as JSON.
+        """
+
+        if any(isinstance(doc.get('mainContent'), str) and len(doc['mainContent']) > 0 for doc in docs):
+            return [truncate_text(doc.get('mainContent')) for doc in docs]
+
+        # The cache is read and written in one round trip each, in a worker thread, so no blocking cache calls stall the requests on the event loop.
+        doc_ids = [doc['id'] for doc in docs]
+        cached = await asyncio.to_thread(handler.get_many, ['full-text-for-id-{}'.format(doc_id) for doc_id in doc_ids], 'full-text')
+        results = [(entry['text'], entry['truncated']) if entry is not None else None for entry in map(self._decode_text_entry, cached)]
+
+        missing_indices = [i for i, result in enumerate(results) if result is None]
+        for _ in range(len(doc_ids) - len(missing_indices)):
+            handler.increment_progress()
+
+        fetched_texts = {}
+        try:
+            fetched_results = await self._request_full_texts(handler, [doc_ids[i] for i in missing_indices], fetched_texts)
+        finally:
+            await asyncio.to_thread(handler.put_many, fetched_texts, 'full-text')
+
+        for i, result in zip(missing_indices, fetched_results):
+            results[i] = result
+
+        return results
+
+    @staticmethod
+    def _decode_text_entry(value: Optional[str]) -> Optional[dict]:
+        return json.loads(value) if value is not None else None
+
+    async def _request_full_texts(self, handler: PipelineStepHandler, doc_ids: list, fetched_texts: dict):
+        tasks = [self._request_full_text_async(doc_id, handler, fetched_texts) for doc_id in doc_ids]
+        return await asyncio.gather(*tasks)
     
 
        
@@ -17,3 +17,10 @@ class PipelineStep(ABC):
     @abstractmethod
     def get_name() -> str:
         pass
+
+    def get_cache_version(self) -> str:
+        """
+            Version of the cache namespace of this step. Steps return a different value whenever a change (e.g. a new prompt) makes their previously cached results invalid.
+        """
+
+        return ''
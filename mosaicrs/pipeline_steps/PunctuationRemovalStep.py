@@ -8,6 +8,7 @@ import mosaicrs.pipeline.PipelineErrorHandling as err
 from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
 from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
 from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
+from mosaicrs.pipeline_steps.utils import deduplicate, log_deduplication
 from tqdm import tqdm
 from typing import Optional
 from nltk.tokenize import word_tokenize
@@ -29,7 +30,7 @@ class PunctuationRemovalStep(PipelineStep):
         self.process_query = True if process_query == "Yes" else False
 
 
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()) -> PipelineIntermediate:
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler) -> PipelineIntermediate:
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step. 
             
@@ -44,6 +45,8 @@ class PunctuationRemovalStep(PipelineStep):
 
 
         inputs = [entry if entry is not None else "" for entry in data.documents[self.input_column].to_list()]
+        inputs, inverse = deduplicate(inputs)
+        log_deduplication(handler, self.get_name(), inverse, inputs)
         outputs = []
 
         if self.process_query:
@@ -51,25 +54,28 @@ class PunctuationRemovalStep(PipelineStep):
         else:
             handler.update_progress(0, len(inputs))
 
-        for input in tqdm(inputs):
+        input_hashes = [hashlib.sha1((self.get_cache_fingerprint() + str(input)).encode()).hexdigest() for input in inputs]
+        cached_outputs = handler.get_many(input_hashes, namespace='punctuation')
+        new_entries = {}
+
+        for input, input_hash, output in tqdm(zip(inputs, input_hashes, cached_outputs), total=len(inputs)):
             if handler.should_cancel:
                 break
 
-            input_hash = hashlib.sha1((self.get_cache_fingerprint() + str(input)).encode()).hexdigest()
-            output = handler.get_cache(input_hash)
-
             if output is None:
                 output = self.process_data_punctuation_removal(input)
-                handler.put_cache(input_hash, output)
+                new_entries[input_hash] = output
 
             outputs.append(output)
             handler.increment_progress()
 
+        handler.put_many(new_entries, namespace='punctuation')
+
         if self.process_query:
             data.query = self.process_data_punctuation_removal(data.query)
             handler.increment_progress()
 
-        data.documents[self.output_column] = outputs
+        data.documents[self.output_column] = [outputs[i] for i in inverse]
         data.set_text_column(self.output_column)
         data.history[str(len(data.history) + 1)] = data.documents.copy(deep=True)
 
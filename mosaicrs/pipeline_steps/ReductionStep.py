@@ -21,7 +21,7 @@ class ReductionStep(PipelineStep):
         self.k = k.strip() if k.strip().isdigit() else "10"
         self.ranking_column = ranking_column
         
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()):
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler):
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step. 
             
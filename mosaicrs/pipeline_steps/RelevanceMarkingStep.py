@@ -5,6 +5,7 @@ from mosaicrs.llm.LiteLLMLLMInterface import LiteLLMLLMInterface
 from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
 from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
 from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
+from mosaicrs.pipeline_steps.utils import deduplicate, log_deduplication
 from difflib import SequenceMatcher
 
 class RelevanceMarkingStep(PipelineStep):
@@ -44,7 +45,7 @@ class RelevanceMarkingStep(PipelineStep):
         self.similarity_threshold = 0.9
 
         
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()):
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler):
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step.  Apply the relevance marking step to the pipeline data.
             
@@ -61,6 +62,8 @@ class RelevanceMarkingStep(PipelineStep):
             raise err.PipelineStepError(err.ErrorMessages.InvalidColumnName, column=self.source_column_name)
 
         full_texts = [entry if entry is not None else "" for entry in data.documents[self.source_column_name].to_list()]
+        full_texts, inverse = deduplicate(full_texts)
+        log_deduplication(handler, self.get_name(), inverse, full_texts)
 
         highlighted_text_list = []
 
@@ -86,7 +89,7 @@ class RelevanceMarkingStep(PipelineStep):
 
             handler.increment_progress()
 
-        data.documents[self.output_column_name] = highlighted_text_list
+        data.documents[self.output_column_name] = [highlighted_text_list[i] for i in inverse]
         data.set_text_column(self.output_column_name)
         data.history[str(len(data.history) + 1)] = data.documents.copy(deep=True)
         return data
@@ -47,7 +47,7 @@ class ResultsSummarizerStep(PipelineStep):
 
 
     
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()):
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler):
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step. The 'transform()' method performs the summarization task by combining the query and all retrieved documents, then generating a unified summary using the selected LLM.
             
@@ -1,15 +1,44 @@
+import asyncio
 import hashlib
+import multiprocessing
+import os
+import time
 
 from abc import abstractmethod
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Optional, Dict, List, Tuple, Callable
 from tqdm import tqdm
+import mosaicrs.pipeline.PipelineErrorHandling as err
 from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
 from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
 from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
+from mosaicrs.pipeline_steps.utils import deduplicate, log_deduplication
+
+
+# Exponential moving averages of the seconds per row that a subclass spends in `transform_row` ('compute') and on the cache ('cache': hashing, lookup and write back), shared by all tasks of the worker.
+_row_costs: Dict[type, Dict[str, float]] = {}
+_row_costs_lock = Lock()
+_cost_smoothing = 0.3
+
+# Process pools are expensive to start, so they are shared by all tasks of the worker (one per pool size). They use 'spawn', since forking a multithreaded server process is unsafe.
+_process_pools: Dict[int, ProcessPoolExecutor] = {}
+_process_pools_lock = Lock()
 
 
 class RowProcessorPipelineStep(PipelineStep):
 
+    # 'auto' skips the cache once computing a row has been measured to be cheaper than caching it, 'always' and 'never' force the decision.
+    cache_policy = 'auto'
+
+    # Number of missed rows passed to one `transform_rows` call. Only used by subclasses that implement `transform_rows`.
+    batch_size = int(os.environ.get('ROW_PROCESSOR_BATCH_SIZE', '32'))
+
+    # How missed rows are computed: 'sequential', 'thread' (I/O bound rows), 'asyncio' (rows implementing `transform_rows_async`) or 'process' (CPU bound rows, the step has to be picklable and `transform_row` gets handler=None). `max_workers` is the degree of parallelism.
+    concurrency = 'sequential'
+    max_workers = int(os.environ.get('ROW_PROCESSOR_MAX_WORKERS', str(os.cpu_count() or 4)))
+
     def __init__(self, input_column: str, output_column: str):
         """
             RowprocessorPipelineStep implements the PipelineStep interface but serves as a specialized base class meant to be extended by other pipeline steps. It overrides the `transform` method from PipelineStep and introduces a new abstract method 'transform_row()' that must be implemented by any subclass deriving from it.
@@ -34,37 +63,88 @@ class RowProcessorPipelineStep(PipelineStep):
         """
          
         inputs = [entry if entry is not None else "" for entry in data.documents[self.input_column].to_list()]
-        outputs = []
         column_type = None
 
-        handler.update_progress(0, len(inputs))
+        # Rows with identical inputs are computed (and looked up) once, the outputs are scattered back at the end.
+        unique_inputs, inverse = deduplicate(inputs, key=str)
+        log_deduplication(handler, self.get_name(), inverse, unique_inputs)
+        inputs = unique_inputs
+        outputs = [None for _ in inputs]
+
+        use_cache = self.should_use_cache()
+        cache_seconds = 0.0
+        compute_seconds = 0.0
+        computed_rows = 0
+
+        if use_cache:
+            start = time.perf_counter()
+            input_hashes = [hashlib.sha1((self.get_cache_fingerprint() + str(input)).encode()).hexdigest() for input in inputs]
+            cached_entries = handler.get_many_with_type(input_hashes, namespace='row')
+            cache_seconds += time.perf_counter() - start
+        else:
+            if self.cache_policy == 'auto':
+                costs = _row_costs[type(self)]
+                handler.log('{}: computing a row is cheaper than caching it ({:.3f} ms vs {:.3f} ms), skipping the cache'.format(
+                    self.get_name(), costs['compute'] * 1000, costs['cache'] * 1000))
+            input_hashes = [None for _ in inputs]
+            cached_entries = [None for _ in inputs]
 
-        for input in tqdm(inputs):
-            if handler.should_cancel:
-                break
+        for i, cached_entry in enumerate(cached_entries):
+            if cached_entry is not None:
+                outputs[i], column_type = cached_entry
 
-            input_hash = hashlib.sha1((self.get_cache_fingerprint() + str(input)).encode()).hexdigest()
-            output = handler.get_cache(input_hash)
+        missing_indices = [i for i, cached_entry in enumerate(cached_entries) if cached_entry is None]
+        handler.update_progress(len(inputs) - len(missing_indices), len(inputs))
 
-            if output is None:
-                output, returned_column_type = self.transform_row(input, handler)
+        # Subclasses without a batched implementation are processed row by row, so progress and cancellation stay fine grained.
+        batch_size = max(1, self.batch_size) if type(self).transform_rows is not RowProcessorPipelineStep.transform_rows else 1
+        batch_indices = [missing_indices[i:i + batch_size] for i in range(0, len(missing_indices), batch_size)]
+        new_entries = {}
+        failures = []
 
-                handler.put_cache(input_hash, output)
-                handler.put_cache(input_hash + 'column_type', returned_column_type)
+        def on_batch_done(batch_number: int, results: Optional[List], error: Optional[Exception]):
+            nonlocal column_type
 
-                if returned_column_type is not column_type:
-                    handler.log(self.get_name() + ": column type: " + returned_column_type)
+            for position, i in enumerate(batch_indices[batch_number]):
+                # A failing row is left empty and not cached, the other rows of its batch were retried one by one and are unaffected.
+                row_error = error if error is not None else results[position] if isinstance(results[position], Exception) else None
+                if row_error is not None:
+                    outputs[i] = ""
+                    failures.append(row_error)
+                    handler.increment_progress()
+                    continue
+
+                output, returned_column_type = results[position]
+                outputs[i] = output
+
+                if use_cache:
+                    new_entries[input_hashes[i]] = (output, returned_column_type)
 
                 if returned_column_type is not None:
+                    if returned_column_type != column_type:
+                        handler.log(self.get_name() + ": column type: " + returned_column_type)
                     column_type = returned_column_type
 
-            else:
-                column_type = handler.get_cache(input_hash + 'column_type')
+                handler.increment_progress()
+
+        try:
+            start = time.perf_counter()
+            self._execute_batches([[inputs[i] for i in indices] for indices in batch_indices], handler, on_batch_done)
+            compute_seconds += time.perf_counter() - start
+            computed_rows += len(missing_indices)
+        finally:
+            if use_cache:
+                start = time.perf_counter()
+                handler.put_many_with_type(new_entries, namespace='row')
+                cache_seconds += time.perf_counter() - start
+
+            self._record_row_costs(compute_seconds, computed_rows, cache_seconds, len(inputs) if use_cache else 0)
 
-            outputs.append(output)
-            handler.increment_progress()
+        if failures:
+            handler.warning(err.PipelineStepWarning(err.WarningMessages.RowProcessingFailed, step=self.get_name(), count=len(failures),
+                                                    exception_name=type(failures[0]).__name__, exception=str(failures[0])))
 
-        data.documents[self.output_column] = outputs
+        data.documents[self.output_column] = [outputs[i] for i in inverse]
         data.history[str(len(data.history) + 1)] = data.documents.copy(deep=True)
 
 
@@ -74,10 +154,150 @@ class RowProcessorPipelineStep(PipelineStep):
         return data
 
 
+    def _execute_batches(self, batches: List[List], handler: PipelineStepHandler, on_batch_done: Callable[[int, Optional[List], Optional[Exception]], None]):
+        """
+            Computes all batches according to `concurrency` and calls `on_batch_done(batch_number, results, error)` in the calling thread for every finished batch, in completion order. Stops submitting work once the handler is cancelled. PipelineStepErrors abort the step. A batch of several rows that raises is retried row by row, so `results` holds the exception in place of every row that failed on its own. A single row that raises (or a batch whose process died) is passed on as `error`.
+        """
+
+        if self.concurrency == 'asyncio':
+            asyncio.run(self._execute_batches_async(batches, handler, on_batch_done))
+            return
+
+        # Rows are retried in the calling thread, process steps get handler=None like in their worker processes.
+        row_handler = None if self.concurrency == 'process' else handler
+        batch_done = on_batch_done
+
+        def on_batch_done(batch_number: int, results: Optional[List], error: Optional[Exception]):
+            if error is not None and len(batches[batch_number]) > 1 and not isinstance(error, BrokenProcessPool):
+                results, error = [self._transform_single_row(data, row_handler) for data in batches[batch_number]], None
+            batch_done(batch_number, results, error)
+
+        if self.concurrency not in ('thread', 'process') or len(batches) <= 1:
+            for batch_number, batch in enumerate(tqdm(batches)):
+                if handler.should_cancel:
+                    break
+
+                try:
+                    results, error = self.transform_rows(batch, handler), None
+                except err.PipelineStepError:
+                    raise
+                except Exception as e:
+                    results, error = None, e
+                on_batch_done(batch_number, results, error)
+            return
+
+        if self.concurrency == 'thread':
+            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            futures = {executor.submit(self.transform_rows, batch, handler): batch_number for batch_number, batch in enumerate(batches)}
+        else:
+            executor = _get_process_pool(self.max_workers)
+            futures = {executor.submit(_transform_rows_in_process, self, batch): batch_number for batch_number, batch in enumerate(batches)}
+
+        try:
+            for future in as_completed(futures):
+                if handler.should_cancel:
+                    break
+
+                try:
+                    results, error = future.result(), None
+                except err.PipelineStepError:
+                    raise
+                except Exception as e:
+                    results, error = None, e
+                    if isinstance(e, BrokenProcessPool):
+                        _discard_process_pool(self.max_workers, executor)
+                on_batch_done(futures[future], results, error)
+        finally:
+            for future in futures:
+                future.cancel()
+
+            if self.concurrency == 'thread':
+                executor.shutdown(wait=False)
+
+    async def _execute_batches_async(self, batches: List[List], handler: PipelineStepHandler, on_batch_done: Callable[[int, Optional[List], Optional[Exception]], None]):
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def execute_batch(batch_number: int, batch: List):
+            async with semaphore:
+                if handler.should_cancel:
+                    return
+
+                try:
+                    results, error = await self.transform_rows_async(batch, handler), None
+                except err.PipelineStepError:
+                    raise
+                except Exception as e:
+                    results, error = None, e
+
+                if error is not None and len(batch) > 1:
+                    results, error = [await self._transform_single_row_async(data, handler) for data in batch], None
+                on_batch_done(batch_number, results, error)
+
+        await asyncio.gather(*[execute_batch(batch_number, batch) for batch_number, batch in enumerate(batches)])
+
+    def _transform_single_row(self, data, handler: Optional[PipelineStepHandler]):
+        # Returns the (output, column_type) tuple of the row or the exception it raised.
+        try:
+            return self.transform_rows([data], handler)[0]
+        except err.PipelineStepError:
+            raise
+        except Exception as e:
+            return e
+
+    async def _transform_single_row_async(self, data, handler: PipelineStepHandler):
+        try:
+            return (await self.transform_rows_async([data], handler))[0]
+        except err.PipelineStepError:
+            raise
+        except Exception as e:
+            return e
+
+    def should_use_cache(self) -> bool:
+        """
+            Decides whether the rows of this step are looked up in and written to the cache. With `cache_policy = 'auto'`, steps are cached until both costs have been measured and then only if computing a row takes at least as long as caching it. Cheap steps like counting words thereby become pure in-memory operations.
+        """
+
+        if self.cache_policy != 'auto':
+            return self.cache_policy == 'always'
+
+        with _row_costs_lock:
+            costs = _row_costs.get(type(self))
+
+        if costs is None or 'compute' not in costs or 'cache' not in costs:
+            return True
+
+        return costs['compute'] >= costs['cache']
+
+    def _record_row_costs(self, compute_seconds: float, computed_rows: int, cache_seconds: float, cached_rows: int):
+        with _row_costs_lock:
+            costs = _row_costs.setdefault(type(self), {})
+
+            for name, seconds, rows in (('compute', compute_seconds, computed_rows), ('cache', cache_seconds, cached_rows)):
+                if rows == 0:
+                    continue
+
+                per_row = seconds / rows
+                costs[name] = per_row if name not in costs else (1 - _cost_smoothing) * costs[name] + _cost_smoothing * per_row
+
+
     @abstractmethod
     def transform_row(self, data, handler: PipelineStepHandler) -> (any, Optional[str]):
         pass
 
+    def transform_rows(self, batch: List, handler: PipelineStepHandler) -> List[Tuple[any, Optional[str]]]:
+        """
+            Optional batched variant of `transform_row`, e.g. for models that are much faster on batches than on single inputs. Receives up to `batch_size` inputs that were not found in the cache and returns one (output, column_type) tuple per input, in the same order. The default implementation calls `transform_row` for every input.
+        """
+
+        return [self.transform_row(data, handler) for data in batch]
+
+    async def transform_rows_async(self, batch: List, handler: PipelineStepHandler) -> List[Tuple[any, Optional[str]]]:
+        """
+            asyncio variant of `transform_rows`, used with `concurrency = 'asyncio'`. Network bound steps should override it with a native coroutine, the default implementation runs `transform_rows` in a worker thread.
+        """
+
+        return await asyncio.to_thread(self.transform_rows, batch, handler)
+
     @abstractmethod
     def get_cache_fingerprint(self) -> str:
         pass
@@ -90,4 +310,23 @@ class RowProcessorPipelineStep(PipelineStep):
     @staticmethod
     @abstractmethod
     def get_name() -> str:
-        pass
\ No newline at end of file
+        pass
+
+
+def _get_process_pool(max_workers: int) -> ProcessPoolExecutor:
+    with _process_pools_lock:
+        if max_workers not in _process_pools:
+            _process_pools[max_workers] = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return _process_pools[max_workers]
+
+
+def _discard_process_pool(max_workers: int, pool: ProcessPoolExecutor):
+    # A pool whose worker died cannot be used anymore, the next step starts a new one.
+    with _process_pools_lock:
+        if _process_pools.get(max_workers) is pool:
+            del _process_pools[max_workers]
+
+
+def _transform_rows_in_process(step: RowProcessorPipelineStep, batch: List) -> List[Tuple[any, Optional[str]]]:
+    # The handler holds locks and cannot be sent to another process.
+    return step.transform_rows(batch, None)
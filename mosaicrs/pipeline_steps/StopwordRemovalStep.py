@@ -29,7 +29,7 @@ class StopWordRemovalStep(PipelineStep):
         self.unsupported_languages = set()
 
 
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()) -> PipelineIntermediate:
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler) -> PipelineIntermediate:
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step. 
             
@@ -51,19 +51,23 @@ class StopWordRemovalStep(PipelineStep):
         else:
             inputs = list(zip(inputs, ["" for _ in inputs]))
 
+        inputs, inverse = utils.deduplicate(inputs)
+        utils.log_deduplication(handler, self.get_name(), inverse, inputs)
+
         pre_processed_outputs = []
 
         self.supported_stopword_sets = self.initialize_stopwords(data)
 
         handler.update_progress(0, len(inputs))
 
-        for input, language in tqdm(inputs):
+        input_hashes = [hashlib.sha1(('rule-based' + str(input)).encode()).hexdigest() for input, _ in inputs]
+        cached_outputs = handler.get_many(input_hashes, namespace='stopwords')
+        new_entries = {}
+
+        for (input, language), input_hash, output in tqdm(zip(inputs, input_hashes, cached_outputs), total=len(inputs)):
             if handler.should_cancel:
                 break
 
-            input_hash = hashlib.sha1(('rule-based' + str(input)).encode()).hexdigest()
-            output = handler.get_cache(input_hash)
-
             if output is None:
                 supported_language = utils.translate_language_code(language)
                 if supported_language and supported_language in self.supported_stopword_sets:
@@ -72,15 +76,17 @@ class StopWordRemovalStep(PipelineStep):
                     output = input
                     self.unsupported_languages.add(language)
 
-                handler.put_cache(input_hash, output)
+                new_entries[input_hash] = output
 
             pre_processed_outputs.append(output)
             handler.increment_progress()
 
+        handler.put_many(new_entries, namespace='stopwords')
+
         if self.unsupported_languages:
             handler.warning(err.PipelineStepWarning(err.WarningMessages.UnsupportedLanguage, languages = ", ".join(self.unsupported_languages)))
 
-        data.documents[self.output_column] = pre_processed_outputs
+        data.documents[self.output_column] = [pre_processed_outputs[i] for i in inverse]
         data.history[str(len(data.history) + 1)] = data.documents.copy(deep=True)
         data.set_text_column(self.output_column)
         
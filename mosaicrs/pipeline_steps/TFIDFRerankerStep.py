@@ -37,7 +37,7 @@ class TFIDFRerankerStep(PipelineStep):
             self.use_new_query = False
 
 
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()) -> PipelineIntermediate:
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler) -> PipelineIntermediate:
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step. Executes the reranking process by computing scores and assigning ranks.   
             
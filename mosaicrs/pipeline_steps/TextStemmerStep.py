@@ -7,7 +7,7 @@ from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
 from mosaicrs.pipeline_steps.PipelineStep import PipelineStep
 from nltk.stem import SnowballStemmer
 from tqdm import tqdm
-from mosaicrs.pipeline_steps.utils import translate_language_code
+from mosaicrs.pipeline_steps.utils import translate_language_code, deduplicate, log_deduplication
 from nltk.tokenize import word_tokenize
 
 class TextStemmerStep(PipelineStep):
@@ -28,7 +28,7 @@ class TextStemmerStep(PipelineStep):
         self.supported_stemmers = {} 
         self.unsupported_languages = set()
 
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()) -> PipelineIntermediate:
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler) -> PipelineIntermediate:
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step. 
             
@@ -48,19 +48,23 @@ class TextStemmerStep(PipelineStep):
         else:
             inputs = list(zip(inputs, ["" for _ in inputs]))
 
+        inputs, inverse = deduplicate(inputs)
+        log_deduplication(handler, self.get_name(), inverse, inputs)
+
         self.supported_stemmers = self.initialize_stemmers(data)
 
         pre_processed_outputs = []
 
         handler.update_progress(0, len(inputs))
 
-        for input, language in tqdm(inputs):
+        input_hashes = [hashlib.sha1(('rule-based' + str(input)).encode()).hexdigest() for input, _ in inputs]
+        cached_outputs = handler.get_many(input_hashes, namespace='stem')
+        new_entries = {}
+
+        for (input, language), input_hash, output in tqdm(zip(inputs, input_hashes, cached_outputs), total=len(inputs)):
             if handler.should_cancel:
                 break
 
-            input_hash = hashlib.sha1(('rule-based' + str(input)).encode()).hexdigest()
-            output = handler.get_cache(input_hash)
-
             if output is None:
                 supported_language = translate_language_code(language)
                 if supported_language and supported_language in self.supported_stemmers:
@@ -69,15 +73,17 @@ class TextStemmerStep(PipelineStep):
                     output = input
                     self.unsupported_languages.add(language)
 
-                handler.put_cache(input_hash, output)
+                new_entries[input_hash] = output
 
             pre_processed_outputs.append(output)
             handler.increment_progress()
 
+        handler.put_many(new_entries, namespace='stem')
+
         if self.unsupported_languages:
             handler.warning(err.PipelineStepWarning(err.WarningMessages.UnsupportedLanguage, languages = ", ".join(self.unsupported_languages)))
 
-        data.documents[self.output_column] = pre_processed_outputs
+        data.documents[self.output_column] = [pre_processed_outputs[i] for i in inverse]
         data.history[str(len(data.history) + 1)] = data.documents.copy(deep=True)
         data.set_text_column(self.output_column)
 
@@ -41,7 +41,7 @@ class TournamentStyleLLMRerankerStep(PipelineStep):
             self.use_new_query = False
 
 
-    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler = PipelineStepHandler()):
+    def transform(self, data: PipelineIntermediate, handler: PipelineStepHandler):
         """
             The 'transform()' method is the core function of each pipeline step. It applies the specific modifications to the 'PipelineIntermediate' object for that step. Perform the tournament-style reranking on the documents.
             
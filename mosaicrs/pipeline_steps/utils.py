@@ -1,8 +1,21 @@
+import os
 import string
 import numpy as np
+from typing import List, Tuple, Optional, Callable
 from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
+from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
 import regex as re
 
+# Ingestion limits of the data sources, see `truncate_text`.
+ingest_max_chars = int(os.environ.get('INGEST_MAX_CHARS', '100000'))
+ingest_truncation = os.environ.get('INGEST_TRUNCATION', 'head_tail').lower()
+
+# Flag column added by the data sources, True for documents whose text was truncated.
+truncated_column = '_truncated_'
+
+_truncation_marker = '\n[…]\n'
+
+
 def translate_language_code(language_code:str):
     """
         Transalates a language code of the ISO 639 Set3 format to a full language name. Example: "eng" -> "english". Only supported languages will be translated, all other langugae codes will return ''. Supported languages are eng/englisch, deu/german, fra/french, and ita/italian.
@@ -63,3 +76,89 @@ def get_most_current_ranking(data: PipelineIntermediate):
         ranking = data.documents["_reranking_rank_"+str(highest_reranking_id)+"_"].to_list()
 
     return ranking
+
+
+def deduplicate(values: list, key: Optional[Callable] = None) -> Tuple[list, List[int]]:
+    """
+        Groups identical row inputs (e.g. empty texts or pages that are contained in several indices), so that a step computes each unique input only once.
+
+        values: list -> The inputs of all rows.\n
+        key: Callable, optional -> Maps a value to the hashable identity used for grouping. Defaults to the value itself.
+
+        Returns the unique values in the order of their first occurrence and, for every row, the index of its unique value. The results are scattered back to the rows with `[unique_results[i] for i in inverse]`.
+    """
+
+    positions = {}
+    unique_values = []
+    inverse = []
+
+    for value in values:
+        identity = key(value) if key is not None else value
+        if identity not in positions:
+            positions[identity] = len(unique_values)
+            unique_values.append(value)
+        inverse.append(positions[identity])
+
+    return unique_values, inverse
+
+
+def log_deduplication(handler: PipelineStepHandler, step_name: str, inverse: List[int], unique_values: list):
+    """
+        Reports in the step log how many rows were saved by `deduplicate`.
+    """
+
+    if len(inverse) > len(unique_values):
+        handler.log('{}: {} rows, {} unique inputs ({} duplicates computed once)'.format(
+            step_name, len(inverse), len(unique_values), len(inverse) - len(unique_values)))
+
+
+def truncate_text(text: Optional[str], max_chars: Optional[int] = None, strategy: Optional[str] = None) -> Tuple[Optional[str], bool]:
+    """
+        Bounds the text of a retrieved document, so single huge pages do not dominate memory, tokenizer and LLM time and the cache size. Cuts are moved to the nearest whitespace, so no word is split.
+
+        text: str -> The document text, values that are not strings are returned unchanged.\n
+        max_chars: int, optional -> Maximum number of characters to keep, 0 keeps the whole text. Defaults to INGEST_MAX_CHARS.\n
+        strategy: str, optional -> 'head' keeps the beginning, 'head_tail' keeps the first two thirds and the last third of the budget (the end of a page often holds its conclusion), 'paragraph' keeps whole paragraphs from the beginning. Defaults to INGEST_TRUNCATION.
+
+        Returns the bounded text and whether it was truncated.
+    """
+
+    max_chars = ingest_max_chars if max_chars is None else max_chars
+    strategy = ingest_truncation if strategy is None else strategy
+
+    if not isinstance(text, str) or max_chars <= 0 or len(text) <= max_chars:
+        return text, False
+
+    if strategy == 'head_tail' and max_chars > 3 * len(_truncation_marker):
+        head = _cut_head(text, (max_chars - len(_truncation_marker)) * 2 // 3)
+        tail = _cut_tail(text, max_chars - len(_truncation_marker) - len(head))
+        return head + _truncation_marker + tail, True
+
+    if strategy == 'paragraph':
+        kept = []
+        length = 0
+        for paragraph in text.split('\n'):
+            if length + len(paragraph) > max_chars:
+                break
+            kept.append(paragraph)
+            length += len(paragraph) + 1
+
+        if length > 0:
+            return '\n'.join(kept).rstrip(), True
+
+    return _cut_head(text, max_chars), True
+
+
+def _cut_head(text: str, max_chars: int) -> str:
+    head = text[:max_chars]
+    cut = max(head.rfind(' '), head.rfind('\n'))
+    return head[:cut].rstrip() if cut > max_chars * 0.8 else head
+
+
+def _cut_tail(text: str, max_chars: int) -> str:
+    if max_chars <= 0:
+        return ''
+
+    tail = text[-max_chars:]
+    cut = min((i for i in (tail.find(' '), tail.find('\n')) if i >= 0), default=-1)
+    return tail[cut + 1:].lstrip() if 0 <= cut < max_chars * 0.2 else tail
@@ -0,0 +1,53 @@
+# train a zstd dictionary for the step cache from values that are currently cached in redis
+# usage: python scripts/train-cache-dictionary.py [step_id]
+# afterwards point CACHE_COMPRESSION_DICT to the written file
+
+
+import os
+import sys
+
+import zstandard
+
+from mosaicrs.pipeline.CacheValueCodec import CacheValueCodec
+from mosaicrs.pipeline.RedisConnection import get_redis
+
+REDIS_CACHE_DB = int(os.environ.get('REDIS_CACHE_DB', '1'))
+OUTPUT_FILE = 'cache-dictionary.zstd'
+
+MAX_SAMPLES = 5000
+DICTIONARY_SIZE = 112 * 1024
+
+
+if __name__ == '__main__':
+    step_id = sys.argv[1] if len(sys.argv) > 1 else '*'
+
+    # same host and port (REDIS_HOST, REDIS_PORT) as the app
+    client = get_redis(db=REDIS_CACHE_DB, decode_responses=False)
+    codec = CacheValueCodec()
+
+    samples = []
+    for key in client.scan_iter(match=f'mosaicrs-cache:{step_id}:*', count=1000):
+        if client.type(key) == b'hash':
+            value = client.hget(key, 'value')
+        else:
+            value = client.get(key)
+
+        # values compressed with a dictionary cannot be decoded without it
+        decoded = codec.decode(value) if value else None
+        if decoded:
+            samples.append(decoded.encode())
+
+        if len(samples) >= MAX_SAMPLES:
+            break
+
+    if len(samples) < 100:
+        print(f'Only found {len(samples)} cached values, run some searches first.')
+        sys.exit(1)
+
+    print(f'Training dictionary on {len(samples)} values...')
+    dictionary = zstandard.train_dictionary(DICTIONARY_SIZE, samples)
+
+    with open(OUTPUT_FILE, 'wb') as f:
+        f.write(dictionary.as_bytes())
+
+    print(f'Wrote {OUTPUT_FILE}, set CACHE_COMPRESSION_DICT to its path to use it.')
@@ -0,0 +1,46 @@
+import pandas as pd
+import pytest
+
+from mosaicrs.pipeline.PipelineIntermediate import PipelineIntermediate
+from mosaicrs.pipeline.PipelineStepHandler import PipelineStepHandler
+from mosaicrs.pipeline_steps.RowProcessorPipelineStep import RowProcessorPipelineStep
+
+
+class UpperCaseStep(RowProcessorPipelineStep):
+    batch_size = 4
+    cache_policy = 'never'
+
+    def transform_row(self, data, handler):
+        if data == 'bad':
+            raise ValueError('bad row')
+        return data.upper(), 'text'
+
+    def transform_rows(self, batch, handler):
+        return [self.transform_row(data, handler) for data in batch]
+
+    def get_cache_fingerprint(self) -> str:
+        return 'upper'
+
+    @staticmethod
+    def get_info() -> dict:
+        return {}
+
+    @staticmethod
+    def get_name() -> str:
+        return 'Upper Case'
+
+
+@pytest.mark.parametrize('concurrency', ['sequential', 'thread', 'asyncio', 'process'])
+def test_failing_row_does_not_empty_its_batch(concurrency):
+    step = UpperCaseStep('text', 'upper')
+    step.concurrency = concurrency
+    handler = PipelineStepHandler()
+
+    rows = ['a', 'b', 'bad', 'c', 'd', 'e']
+    data = PipelineIntermediate('query', {})
+    data.documents = pd.DataFrame({'text': rows})
+
+    result = step.transform(data, handler)
+
+    assert result.documents['upper'].to_list() == ['A', 'B', '', 'C', 'D', 'E']
+    assert handler.progress == (len(rows), len(rows))